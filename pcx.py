@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+PCX codec for mugen toolchain
+(C) 2023 Kumohakase
+CC BY-SA 4.0 https://creativecommons.org/licenses/by-sa/4.0/
+Please consider supporting me through ko-fi.com
+https://ko-fi.com/kumohakase
+
+Shared by sff.py, sprmaker.py and sff_extractor.py.
+Only 256 indexed color (8bpp, 1 plane) RLE pcx is supported.
+Pixels are handled as bytes of width * height octets (row major, 1 octet per pixel).
+Hot loops are done by re module (C) instead of per octet python loop.
+
+PCX file structure:
+Header (Offset = 0, 128 octets)
++0x0, uint8_t, Manufacturer (0xa)
++0x1, uint8_t, Version (5)
++0x2, uint8_t, Encoding (1 = RLE)
++0x3, uint8_t, Bits per pixel (8)
++0x4, uint16_t, Xmin
++0x6, uint16_t, Ymin
++0x8, uint16_t, Xmax
++0xa, uint16_t, Ymax
++0xc, uint16_t, Horizontal DPI
++0xe, uint16_t, Vertical DPI
++0x10, 48 octets, 16 color palette (unused)
++0x40, uint8_t, Reserved (0)
++0x41, uint8_t, Plane count (1)
++0x42, uint16_t, Bytes per line (width rounded up to even number)
++0x44, uint16_t, Palette info (1)
++0x46, 58 octets, Reserved (0)
+
+Image data (Offset = 0x80)
+RLE encoded scanlines, octet 0xc0 - 0xff means repeat next octet (octet & 0x3f) times,
+otherwise octet is pixel itself.
+
+Palette (last 769 octets)
+0xc followed by 256 * RGB
+"""
+import re, struct
+
+PCX_HEADER = "<BBBBHHHHHH48sBBHH58s"
+PCX_HEADER_LEN = 0x80
+
+#octet 0xc0 - 0xff and its next octet (run)
+PCX_RUN_RX = re.compile(rb"[\xc0-\xff][\x00-\xff]")
+#repeating octet (2 or more)
+PCX_REPEAT_RX = re.compile(rb"([\x00-\xff])\1+")
+#octet that can not be written without run
+PCX_HIGH_RX = re.compile(rb"[\xc0-\xff]")
+PCX_ESCAPE = {bytes((c, )): bytes((0xc1, c)) for c in range(0xc0, 0x100)}
+#expanded octets of every possible run, built on first decode
+PCX_RUNS = None
+
+#check if pcxdata has palette, returns True if it has, otherwise false
+def pcx_haspalette(pcxdata):
+	#check for palette indicator located in last 769 octets
+	if len(pcxdata) < 769 or pcxdata[-769] != 12:
+		return False
+	else:
+		return True
+
+#Remove palette from pcx data if it has palette data
+def pcx_tryremovepal(pcxdata):
+	if pcx_haspalette(pcxdata):
+		return pcxdata[:-769]
+	return pcxdata
+
+#returns (width, height, bytes per line) of pcxdata, returns None if it is not
+#256 indexed color pcx
+def pcx_getinfo(pcxdata):
+	if len(pcxdata) < PCX_HEADER_LEN:
+		return None
+	if pcxdata[0] != 0xa or pcxdata[2] != 1 or pcxdata[3] != 8 or pcxdata[0x41] != 1:
+		return None
+	xmin, ymin, xmax, ymax = struct.unpack_from("<HHHH", pcxdata, 4)
+	bpl = struct.unpack_from("<H", pcxdata, 0x42)[0]
+	w = xmax - xmin + 1
+	h = ymax - ymin + 1
+	if w <= 0 or h <= 0 or bpl < w:
+		return None
+	return (w, h, bpl)
+
+#decode pcxdata, returns (width, height, pixels, palette), palette is 768 octets of RGB
+#or None if pcxdata does not have palette. returns None if pcxdata is broken
+def pcx_decode(pcxdata):
+	t = pcx_getinfo(pcxdata)
+	if t == None:
+		return None
+	w, h, bpl = t
+	global PCX_RUNS
+	if PCX_RUNS == None:
+		PCX_RUNS = {bytes((0xc0 | n, c)): bytes((c, )) * n for n in range(64) for c in range(256)}
+	palette = None
+	end = len(pcxdata)
+	if pcx_haspalette(pcxdata):
+		palette = bytes(pcxdata[-768:])
+		end -= 769
+	#expand all runs at once, literal octets are copied by re module as is
+	raw = PCX_RUN_RX.sub(lambda m: PCX_RUNS[m[0]], bytes(pcxdata[PCX_HEADER_LEN:end]))
+	#RLE data must be exactly bpl x height octets
+	if len(raw) != bpl * h:
+		return None
+	#strip padding of each scanline
+	if bpl == w:
+		pixels = raw[:w * h]
+	else:
+		pixels = b"".join([raw[y:y + w] for y in range(0, bpl * h, bpl)])
+	return (w, h, pixels, palette)
+
+#RLE encode one scanline row with fewest octets
+def pcx_encoderow(row):
+	r = []
+	pos = 0
+	for m in PCX_REPEAT_RX.finditer(row):
+		s = m.start()
+		#literal part, only 0xc0 - 0xff need to be written as 1 octet run
+		if s > pos:
+			r.append(PCX_HIGH_RX.sub(lambda e: PCX_ESCAPE[e[0]], row[pos:s]))
+		c = row[s]
+		n = m.end() - s
+		if n >= 63:
+			r.append(bytes((0xff, c)) * (n // 63))
+			n %= 63
+		if n == 1 and c < 0xc0:
+			r.append(bytes((c, )))
+		elif n != 0:
+			r.append(bytes((0xc0 | n, c)))
+		pos = m.end()
+	if pos < len(row):
+		r.append(PCX_HIGH_RX.sub(lambda e: PCX_ESCAPE[e[0]], row[pos:]))
+	return b"".join(r)
+
+#encode width x height pixels to pcx, palette is 768 octets of RGB or None
+#(palette will be omitted)
+def pcx_encode(width, height, pixels, palette = None):
+	bpl = width + (width & 1) #bytes per line must be even
+	hdr = struct.pack(PCX_HEADER, 0xa, 5, 1, 8, 0, 0, width - 1, height - 1, 72, 72, b"", 0, 1,
+		bpl, 1, b"")
+	pixels = bytes(pixels)
+	pad = b"\0" * (bpl - width)
+	r = [hdr]
+	for y in range(0, width * height, width):
+		r.append(pcx_encoderow(pixels[y:y + width] + pad))
+	if palette != None:
+		r.append(b"\x0c")
+		r.append(bytes(palette))
+	return b"".join(r)
+
+#returns bounding box (left, top, right, bottom) of non transparent (non zero) pixels,
+#right and bottom are exclusive. returns None if all pixels are transparent
+def pcx_boundingbox(width, height, pixels):
+	pixels = bytes(pixels)
+	s = pixels.lstrip(b"\0")
+	if len(s) == 0:
+		return None
+	top = (len(pixels) - len(s)) // width
+	bottom = (len(pixels.rstrip(b"\0")) - 1) // width + 1
+	left = width
+	right = 0
+	for y in range(top * width, bottom * width, width):
+		row = pixels[y:y + width]
+		l = width - len(row.lstrip(b"\0"))
+		#skip empty row
+		if l == width:
+			continue
+		if l < left:
+			left = l
+		r = len(row.rstrip(b"\0"))
+		if r > right:
+			right = r
+	return (left, top, right, bottom)
+
+#remove transparent area around image of pcxdata, returns (newpcxdata, left, top)
+#left and top are removed width and height. returns None if image can not be decoded or
+#cropped image is not smaller than original
+def pcx_autocrop(pcxdata):
+	t = pcx_decode(pcxdata)
+	if t == None:
+		return None
+	w, h, pixels, palette = t
+	box = pcx_boundingbox(w, h, pixels)
+	#leave one transparent pixel for empty image
+	if box == None:
+		box = (0, 0, 1, 1)
+	l, top, r, b = box
+	if box == (0, 0, w, h):
+		return None
+	cropped = b"".join([pixels[y + l:y + r] for y in range(top * w, b * w, w)])
+	d = pcx_encode(r - l, b - top, cropped, palette)
+	if len(d) >= len(pcxdata):
+		return None
+	return (d, l, top)
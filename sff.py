@@ -7,20 +7,34 @@ Please consider supporting me through ko-fi.com
 https://ko-fi.com/kumohakase
 """
 
-import sys, os, struct, tempfile
+import sys, os, stat, struct, tempfile, mmap, array, bisect, hashlib, collections, json, shlex
+import time, threading, contextlib, concurrent.futures, ctypes, select, zlib, io, tarfile, zipfile
+from pcx import pcx_haspalette, pcx_tryremovepal, pcx_autocrop, pcx_getinfo, pcx_decode, pcx_encode
+from sffv2 import SffV2Archive, SpriteNode, sffv2_isv2, sffv2_write, sffv2_encode
 
 PROGNAME = sys.argv[0]
 
-HELPMSG = f"""{PROGNAME} {{c|d|t|x|r|o|?}} [sfffile] [options]
+HELPMSG = f"""{PROGNAME} {{c|d|t|x|e|r|o|b|s|w|m|p|v|?}} [sfffile] [options]
 
 c: create/append mode
 d: delete mode
 t: list mode
 x: extract mode
+e: export mode
 r: reorder mode
 o: optomization mode
+b: batch mode
+s: sff v1 <-> v2 convert mode
+w: watch mode
+m: make patch mode
+p: patch mode
+v: verify mode
 ?: show this message
 
+Common options:
+--stats: show per phase wall time and I/O counters after run
+--stats-json file: write them into file as JSON
+
 return code 0 - OK
 return code 1 or greater - Error
 
@@ -31,7 +45,11 @@ specified index in order of file registration order.
 -g group: Apply operation for images that have specified group numbers.
 -n number: Should be used with -g, apply operation for images that have specified group number \
  and image number.
-index, group, number can be range like 10:20 (form 10 to 20)
+index, group, number can be range like 10:20 (form 10 to 20), list of numbers and ranges
+like 0:99,5000,9000:9010, and numbers with ! are excluded like 0:99,!50 (only !50 means
+all except 50). Each option can be repeated (-g 0 -g 5000 is same as -g 0,5000).
+-I: Use (group, image) index file sfffile.idx to find images, create it if missing.
+(If index file exists, it is always used and rebuilt when it is stale.)
 """
 
 HELPMSG_LIST = f"""List mode, Lists contained images of sfffile
@@ -39,7 +57,18 @@ HELPMSG_LIST = f"""List mode, Lists contained images of sfffile
 
 Options:
 {HELPMSG_SELOPT}
-If there was no option, it means list all."""
+If there was no option, it means list all.
+Only quick checks (pcx header and palette) are done, use verify mode for full check."""
+
+HELPMSG_VERIFY = f"""Verify mode, fully check sfffiles (and sff files in directories)
+{PROGNAME} v sfffile|directory... [options]
+
+Options:
+-j jobs: number of processes that decode images (default: cpu count)
+
+Checks subheader chain, overlapping subheaders and image data, link targets,
+duplicated group/image numbers, palette rules, and decodes every pcx to make sure
+its RLE data has width x height pixels. Problems are shown in image index order."""
 
 HELPMSG_EXTRACT = f"""Extract mode, extract sfffile and store into outdir
 {PROGNAME} x sfffile outdir [options]
@@ -47,18 +76,42 @@ HELPMSG_EXTRACT = f"""Extract mode, extract sfffile and store into outdir
 Options:
 -f: add basic infomation to filename (like id_group#_image#_x_y.pcx)
 -p: export palette of image stored on top of sff (shared palette)
+-j jobs: number of files written in parallel (default: depends on cpu count)
 {HELPMSG_SELOPT}
 If there was no option, it means extract all."""
 
+HELPMSG_EXPORT = f"""Export mode, store images of sfffile into one tar or zip (uncompressed) archive
+{PROGNAME} e sfffile outfile [options]
+
+Options:
+-f: detailed filename (like extract mode)
+-p: also store palette of image stored on top of sff as shared.act
+-T tar|zip: archive format (default: zip if outfile ends with .zip, otherwise tar)
+{HELPMSG_SELOPT}
+If outfile is "-", archive is written into stdout (messages are written into stderr).
+Images are stored like extract mode, and archive also has "filelist" of create mode
+(linked images refer file of link destination, use -f of create mode to link them again).
+If there was no option, it means export all."""
+
 HELPMSG_CREATE = """Create mode, create new sfffile/append images in infiledir to new sfffile
 {PROGNAME} c sfffile infiledir [options]
+{PROGNAME} c sfffile archive [options]
 
 Options:
--c: auto remove empty area of images. (Not yet implemented)
+-c: auto remove empty area of images.
 -f: link duplicate images (files that shares same filename).
 -p: remove palette data from image when shared palette mode.
+-I: write (group, image) index file sfffile.idx for fast lookups.
+-u: incremental build, rebuild sfffile from infiledir (instead of appending to it) and
+keep build manifest sfffile.build. On next -u build, images whose pcx file is not changed
+are copied from previous sfffile without decoding, sfffile is not rewritten if nothing changed.
 
 infiledir is directory that contains pcx files to append to sfffile
+archive is tar (may be compressed) or zip file that contains same files as infiledir,
+or "-" to read tar stream from stdin. Files are read from archive without extracting them,
+if filelist (or all files) is in one directory in archive, it is used as infiledir.
+Tar is read in one pass, put filelist first and pcx files in filelist order (like export
+mode does) to keep memory usage low.
 pcx filename format should be id_grp_img_x_y_shared.pcx
 id: processing order, unique grp: desired group number
 img: desired image number x, y: desired coordinate
@@ -91,31 +144,96 @@ HELPMSG_DELETE = f"""Delete mode: delete image files in sff
 
 Options:
 -y: Do not confirm when deleting. Use with caution.
+-C: Compact sff after deleting (rewrite whole sff to reclaim space of deleted images).
 {HELPMSG_SELOPT}
-You need to specify at least -i, -g or -n."""
+You need to specify at least -i, -g or -n.
+Without -C, deleted images are just unlinked from subheader chain and their space
+is left as dead space. Use "o sfffile -z" later to reclaim it."""
 
-HELPMSG_REORDER = """Reorder mode, change sff image file order of specified image.
-{PROGNAME} r sfffile options index1 index2
+HELPMSG_REORDER = f"""Reorder mode, change sff image file order of specified image.
+{PROGNAME} r sfffile index1 index2
+{PROGNAME} r sfffile -P permfile
 
-Not yet implemented.
-Changes location of image in index1 to index2"""
+Changes location of image in index1 to index2.
+With -P, images are reordered as permfile says. permfile contains current indexes of
+all images in new order (separated by spaces or newlines).
+Linked image can not be placed before image it is linked to.
+Only subheaders are rewritten, image data are not moved."""
 
 HELPMSG_OPTIMIZE = f"""Optimize mode, tries to reconstruct sff with specified shrinking options
 {PROGNAME} o sfffile [options]
 
-Not yet implemented.
 -c: auto remove empty area of images.
 -f: compare images and detect same file, then link them.
--p: delete palette information from shared palette images"""
+-p: find images that have same palette as index0 image (shared palette),
+    then set shared palette mode and delete palette from them.
+-z: reclaim dead space left by delete mode (any other option does it too)"""
+
+HELPMSG_BATCH = f"""Batch mode, apply many operations to sfffile and rewrite it only once
+{PROGNAME} b sfffile scriptfile
+
+scriptfile is text file that has one operation per line (# for comment),
+or JSON list of operation objects. Operations are applied in order, and index means
+image index at that time (after previous operations).
+
+Text                                   JSON
+delete [-i index] [-g group] [-n num]  {{"op": "delete", "i": "1:3", "g": "9000", "n": "0"}}
+append infiledir [-f] [-p]             {{"op": "append", "dir": "infiledir", "f": true, "p": true}}
+renumber index group# image#           {{"op": "renumber", "index": 1, "group": 0, "image": 0}}
+reorder index1 index2                  {{"op": "reorder", "from": 1, "to": 2}}
+axis index x y                         {{"op": "axis", "index": 1, "x": 0, "y": 0}}
+shared index 0|1                       {{"op": "shared", "index": 1, "shared": true}}
+
+delete takes selector like delete mode (-i, -g, -n), append takes infiledir like
+create mode (filelist or pcx filenames) and -f, -p options of create mode.
+If any operation fails, sfffile is untouched."""
+
+HELPMSG_CONVERT = f"""Convert mode, convert sff v1 sfffile into sff v2 newfile, or sff v2 into sff v1
+{PROGNAME} s sfffile newfile [options]
+
+Options:
+{HELPMSG_SELOPT}
+If there was no option, it means convert all. (-I is used only for sff v1 sfffile)
+Images linked to image that is not selected are stored as actual image.
+sff v2 output stores each different palette once, index0 image of sff v1 output has
+palette and images that use same palette are stored in shared palette mode."""
+
+HELPMSG_WATCH = f"""Watch mode, keep sfffile in sync with images in infiledir
+{PROGNAME} w sfffile infiledir [options]
+
+Options:
+-c, -f, -p, -I: same as create mode.
+
+sfffile is built like create mode with -u (incremental build), then whenever pcx files
+or filelist in infiledir are changed, only changed images are read again and sfffile is
+rebuilt. Changes are detected by inotify if available, otherwise by polling infiledir.
+Press Ctrl+C to stop."""
+
+HELPMSG_DIFF = f"""Make patch mode, compare sfffile and newsff and write patch that updates sfffile to newsff
+{PROGNAME} m sfffile newsff patchfile
+
+Images are compared by content (image data hash), patch contains image information of all
+images in newsff and image data of only added or changed images. Images that are
+also in sfffile (even with other group/image number or position) are copied from sfffile
+when the patch is applied."""
+
+HELPMSG_PATCH = f"""Patch mode, apply patch made by make patch mode to sfffile
+{PROGNAME} p sfffile patchfile [newsff]
+
+If newsff is omitted, sfffile is replaced by patched sff.
+Patch can be applied only to same sfffile as it was made from."""
 
 #find command line option s then return next param, returns None if s not found, returns "" 
 #if no next param
-def getoption(s):
-	for i in range(len(sys.argv)):
-		e = sys.argv[i]
+#args is command line to search (default: sys.argv)
+def getoption(s, args = None):
+	if args == None:
+		args = sys.argv
+	for i in range(len(args)):
+		e = args[i]
 		if e == s:
-			if i + 1 < len(sys.argv):
-				return sys.argv[i + 1]
+			if i + 1 < len(args):
+				return args[i + 1]
 			else:
 				return ""
 	return None
@@ -126,117 +244,147 @@ def in_range(p, mi, ma):
 		return False
 	return True
 
-#decode "4500:6300" to (4500, 6300) and decode "450" to 450, returns None if conversion failed
-#or out of range of minval and maxval
+#find command line option s and return list of all next params (option can be repeated)
+#args is command line to search (default: sys.argv)
+def getoptions(s, args = None):
+	if args == None:
+		args = sys.argv
+	r = []
+	for i in range(len(args)):
+		if args[i] == s:
+			r.append(args[i + 1] if i + 1 < len(args) else "")
+	return r
+
+#decode "4500:6300" to (4500, 6300) and decode "450" to (450, 450), returns None if conversion
+#failed or out of range of minval and maxval
 def decode_nrange_str(s, minval, maxval):
-	if ":" in s:
-		#split values into 2 and try to convert those to int
-		t = s.split(":")
-		try:
-			n1 = int(t[0])
-			n2 = int(t[1])
-		except(ValueError):
-			return None
-		#first value can't be larger than second one
-		if n1 > n2:
-			return None
-		#check range
-		if in_range(n1, minval, maxval) and in_range(n2, minval, maxval):
-			return (n1, n2)
-	else:
-		#single number, try convert and check range
-		try:
-			t = int(s)
-		except(ValueError):
-			return None
-		if in_range(t, minval, maxval):
-			return t
-		else:
-			return None
+	t = s.split(":")
+	if len(t) > 2:
+		return None
+	try:
+		n1 = int(t[0])
+		n2 = int(t[-1])
+	except(ValueError):
+		return None
+	#first value can't be larger than second one
+	if n1 > n2:
+		return None
+	#check range
+	if in_range(n1, minval, maxval) and in_range(n2, minval, maxval):
+		return (n1, n2)
+	return None
 
-#decode selection filter command line switch, returns None if error
-def getselectionfilter():
+#decode values (list of option params like "0:99,5000,!50") into sorted list of disjoint
+#(min, max) ranges, numbers with ! are excluded (only excluded numbers means all except them).
+#returns None if conversion failed or out of range of minval and maxval
+def decode_nranges(values, minval, maxval):
+	plus = []
+	minus = []
+	for v in values:
+		for e in v.split(","):
+			neg = e[:1] == "!"
+			t = decode_nrange_str(e[1:] if neg else e, minval, maxval)
+			if t == None:
+				return None
+			(minus if neg else plus).append(t)
+	if len(plus) == 0:
+		plus.append((minval, maxval))
+	#merge overlapping and adjacent ranges
 	r = []
-	t = None
-	i_cond = getoption("-i")
-	if i_cond != None:
-		t = decode_nrange_str(i_cond, 0, 65535)
-		#decode error or out of range
-		if t == None:
-			print("-i: Must be number, range 0 - 65535")
-			return None
-	r.append(t)
-	t = None
-	g_cond = getoption("-g")
-	if g_cond != None:
-		#exclusive with -i
-		if i_cond != None:
-			print("-g: Can not be used with -i")
-			return None
-		t = decode_nrange_str(g_cond, 0, 65535)
-		if t == None:
-			print("-g: Must be number, range 0 - 65535")
-			return None
-	r.append(t)
-	t = None
-	n_cond = getoption("-n")
-	if n_cond != None:
-		#exclusive with -i
-		if i_cond != None:
-			print("-n: Can not be used with -i")
-			return None
-		#Accept only with -g
-		if g_cond == None:
-			print("-n: Please use with -g")
-			return None
-		t = decode_nrange_str(n_cond, 0, 65535)
-		if t == None:
-			print("-n: Must be number, range 0 - 65535")
-			return None
-	r.append(t)
+	for lo, hi in sorted(plus):
+		if len(r) != 0 and lo <= r[-1][1] + 1:
+			r[-1] = (r[-1][0], max(r[-1][1], hi))
+		else:
+			r.append((lo, hi))
+	#cut excluded ranges out
+	for mlo, mhi in minus:
+		t = []
+		for lo, hi in r:
+			if hi < mlo or lo > mhi:
+				t.append((lo, hi))
+				continue
+			if lo < mlo:
+				t.append((lo, mlo - 1))
+			if hi > mhi:
+				t.append((mhi + 1, hi))
+		r = t
 	return r
 
-#Returns true if i == sel, If sel is tuple, returns true if i is in range of
-#sel[0] and sel[1], otherwise false
-def eval_selector_elem(sel, i):
-	if type(sel) == int:
-		if sel == i:
-			return True
-	else:
-		if in_range(i, sel[0], sel[1]):
-			return True
-	return False
+#Selection filter given by command parameter -i, -g and -n, compiled once.
+#i, g, n: None (not specified, matches all) or sorted list of disjoint (min, max) ranges
+#of image index, group# and image#. group# and image# are also compiled into bitsets
+#(65536 octets, 1 if selected) for scanning all images.
+class SffSelector:
+	ALL = b"\1" * 65536
 
-#compare selection filter given by command parameter -i, -g and -n, and current file
-def decodeselectionfilter(selector, c_i, c_g, c_n):
-	dst = (c_i, c_g, c_n)
-	t = 0
-	for i in range(len(selector)):
-		e = selector[i]
-		#None means specified condition not set (always TRUE)
-		if e != None:
-			if eval_selector_elem(e, dst[i]):
-				t += 1
-		else:
-			t += 1
-	#if all selectors = True, return true
-	if t == len(dst):
-		return True
-	return False
+	def __init__(self, i, g, n):
+		self.i = i
+		self.g = g
+		self.n = n
+		self.gbits = self.bitset(g)
+		self.nbits = self.bitset(n)
 
-#check if pcxdata has palette, returns True if it has, otherwise false
-def pcx_haspalette(pcxdata):
-	#check for palette indicator located in last 769 octets
-	if len(pcxdata) < 769 or pcxdata[-769] != 12:
-		return False
-	else:
-		return True
+	#returns bitset of ranges
+	@staticmethod
+	def bitset(ranges):
+		if ranges == None:
+			return SffSelector.ALL
+		r = bytearray(65536)
+		for lo, hi in ranges:
+			r[lo:hi + 1] = SffSelector.ALL[lo:hi + 1]
+		return bytes(r)
+
+	#returns True if nothing is specified (selects all images)
+	def isall(self):
+		return self.i == None and self.g == None and self.n == None
+
+	#returns True if image of index i, group# g and image# n is selected
+	def match(self, i, g, n):
+		if self.i != None:
+			k = bisect.bisect_right(self.i, (i, 65536)) - 1
+			if k < 0 or i > self.i[k][1]:
+				return False
+		return self.gbits[g] != 0 and self.nbits[n] != 0
+
+	#returns sorted list of image indexes selected from count images that have groups and
+	#images (group# and image# columns) without index
+	def scan(self, count, groups, images):
+		if self.i != None:
+			r = []
+			for lo, hi in self.i:
+				r.extend(range(lo, min(hi, count - 1) + 1))
+			return r
+		gb = self.gbits
+		nb = self.nbits
+		return [k for k, g, n in zip(range(count), groups, images) if gb[g] and nb[n]]
+
+#decode selection filter command line switch, returns SffSelector or None if error
+#args is command line to decode (default: sys.argv)
+def getselectionfilter(args = None):
+	sel = []
+	for k, name in (("-i", "index"), ("-g", "group"), ("-n", "number")):
+		values = getoptions(k, args)
+		t = None
+		if len(values) != 0:
+			t = decode_nranges(values, 0, 65535)
+			#decode error or out of range
+			if t == None:
+				print(f"{k}: Must be {name} or range or list of them, range 0 - 65535")
+				return None
+		sel.append(t)
+	#-g and -n are exclusive with -i
+	if sel[0] != None and (sel[1] != None or sel[2] != None):
+		print(f"{'-g' if sel[1] != None else '-n'}: Can not be used with -i")
+		return None
+	#Accept -n only with -g
+	if sel[2] != None and sel[1] == None:
+		print("-n: Please use with -g")
+		return None
+	return SffSelector(sel[0], sel[1], sel[2])
 
-#Remove palette from pcx data if it has palette data
-def pcx_tryremovepal(pcxdata):
-	if pcx_haspalette(pcxdata):
-		return pcxdata[:-769]
-	return pcxdata
+#compare selection filter given by command parameter -i, -g and -n, and current file
+def decodeselectionfilter(selector, c_i, c_g, c_n):
+	return selector.match(c_i, c_g, c_n)
 
 #returns true if group no, image no, x and y are in acceptable range.
 def sff_checkparam(grp, img, x, y):
@@ -244,6 +392,21 @@ def sff_checkparam(grp, img, x, y):
 		return True
 	return False
 
+#returns true if axis x and y are in acceptable range.
+def sff_checkaxis(x, y):
+	if -32768 <= x <= 32767 and -32768 <= y <= 32767:
+		return True
+	return False
+
+#remove empty area of image data, axis x and y are moved to keep image position.
+#returns (data, x, y, crop) crop is (removed width, removed height) or None if
+#image was not cropped
+def sff_autocrop(data, x, y):
+	t = pcx_autocrop(data)
+	if t == None or not sff_checkaxis(x - t[1], y - t[2]):
+		return (data, x, y, None)
+	return (t[0], x - t[1], y - t[2], (t[1], t[2]))
+
 #get optimal offset of next subheader when current subheader offset
 #is ptr and image size is filelen
 def sff_getoptimaloffset(ptr, filelen):
@@ -254,8 +417,28 @@ def sff_getoptimaloffset(ptr, filelen):
 		return r + (16 - leftover)
 	return r
 
+#returns offset where new subheader can be placed after all images,
+#offsets and sizes are image data offsets and lengths of images
+def sff_getendoffset(offsets, sizes):
+	r = 0x200
+	for off, size in zip(offsets, sizes):
+		r = max(r, sff_getoptimaloffset(off - 0x20, size))
+	return r
+
+#returns size of sff when images of sizes (image data lengths) are written without any gap
+#(same as sff_reconstruct output)
+def sff_getcompactsize(sizes):
+	r = 0x200
+	for size in sizes[:-1]:
+		r = sff_getoptimaloffset(r, size)
+	if len(sizes) != 0:
+		r += 0x20 + sizes[-1]
+	return r
+
 #write sff header, imglen: image count
 def sff_writeheader(sff, imglen):
+	sff_count("seeks")
+	sff_countwrite(0x6f)
 	sff.seek(0)
 	sff.write(b"ElecbyteSpr\0\0\x01\0\x01")
 	sff.write(struct.pack("<LLLLB", 0, imglen, 0x200, 0x20, 1))
@@ -277,78 +460,706 @@ def sff_generatesubheader(nextptr, filelen, x, y, grp, img, linkid, pal):
 	hdr += b"\0\0\0\0\0\0\0\0\0\0\0\0\0"
 	return hdr
 
-#write ctx in binary file fname
-def writebin(fname, ctx):
+#write ctx in binary file fname, ctx can be split into multiple chunks
+#(bytes or memoryview) to avoid concatenating them
+def writebin(fname, *ctx):
 	f = open(fname, "wb")
-	f.write(ctx)
+	sff_count("files_opened")
+	for c in ctx:
+		f.write(c)
+		sff_countwrite(len(c))
 	f.close()
 
-#Read sff and get information, return None if fail
-#list element content = [image offset, size, x, y, group#, image#, link index, palette mode]
-def sff_getinfo(sff):
-	sff.seek(0)
-	hdr = sff.read(0x1c) #read header
-	#check read size
-	if len(hdr) < 0x1c:
-		print("Fatal: Broken sff.")
-		return None
-	#Check for header
-	if hdr[0:0x10] != b"ElecbyteSpr\0\0\x01\0\x01":
-		print("Fatal: Wrong file identifier.")
-		return None
-	hp =  struct.unpack("<LL", hdr[0x14:0x1c]) #image_count, subheader_offset
-	#+0x1c uint32_t (subheader len) seems to be ignored in mugen and assumed 0x20
-	ptr = hp[1] #pointer for subfiles in sff
-	img_info = []
-	for i in range(hp[0]):
-		sff.seek(ptr) #seek to next subheader offset
-		hdr = sff.read(0x13) #read subheader
+#context manager that writes new file fname through temporary file in same directory,
+#returns binary file object of temporary file. when block is finished, temporary file is
+#synced and renamed to fname atomically with permission of existing fname (or default
+#permission for new file). if block raises, temporary file is removed and fname is untouched
+class SffReplaceFile:
+	def __init__(self, fname, buffering = -1):
+		self.fname = fname
+		self.buffering = buffering
+
+	def __enter__(self):
+		fd, self.tmpname = tempfile.mkstemp(prefix = ".sff",
+			dir = os.path.dirname(os.path.abspath(self.fname)))
+		self.file = os.fdopen(fd, "wb", buffering = self.buffering)
+		sff_count("files_opened")
+		return self.file
+
+	def __exit__(self, exc, value, tb):
+		if exc != None:
+			self.discard()
+			return False
+		try:
+			self.file.flush()
+			os.fsync(self.file.fileno())
+			self.file.close()
+			#mkstemp creates file with 0600, keep permission of existing fname or use default
+			if os.path.exists(self.fname):
+				os.chmod(self.tmpname, stat.S_IMODE(os.stat(self.fname).st_mode))
+			else:
+				mask = os.umask(0)
+				os.umask(mask)
+				os.chmod(self.tmpname, 0o666 & ~mask)
+			os.replace(self.tmpname, self.fname)
+		except:
+			self.discard()
+			raise
+		return False
+
+	#close and remove temporary file
+	def discard(self):
+		self.file.close()
+		os.remove(self.tmpname)
+
+#Statistics of current run, None if disabled. Instrumented code only checks this when
+#disabled (see sff_phase, sff_count)
+sff_stats = None
+
+#Statistics of one run
+#phases: phase name -> [call count, seconds], time of nested phase is also included in
+#outer phase (extract "write" includes "palette")
+#counters: counter name -> value, see COUNTERS
+#hooks: functions called on every event as hook(kind, name, value), kind is "phase"
+#(value = seconds) or "count" (value = increment). hook may be called from worker threads.
+class SffStats:
+	COUNTERS = ("seeks", "reads", "read_bytes", "writes", "written_bytes", "files_opened",
+		"sprites")
+
+	def __init__(self):
+		self.phases = {}
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self.hooks = []
+		self.lock = threading.Lock()
+
+	def addtime(self, name, seconds):
+		with self.lock:
+			p = self.phases.setdefault(name, [0, 0.0])
+			p[0] += 1
+			p[1] += seconds
+		for h in self.hooks:
+			h("phase", name, seconds)
+
+	def count(self, name, n = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+		for h in self.hooks:
+			h("count", name, n)
+
+	#returns summary table string
+	def table(self):
+		r = [f"{'Phase':16}{'Calls':>10}{'Seconds':>12}"]
+		for name, (c, t) in self.phases.items():
+			r.append(f"{name:16}{c:10}{t:12.4f}")
+		r.append(f"{'Counter':16}{'Value':>22}")
+		for name, v in self.counters.items():
+			r.append(f"{name:16}{v:22}")
+		return "\n".join(r)
+
+	#returns statistics as dict (for JSON)
+	def todict(self):
+		return {"phases": {k: {"calls": c, "seconds": t} for k, (c, t) in self.phases.items()},
+			"counters": dict(self.counters)}
+
+#context manager that adds elapsed time to phase name of sff_stats
+class SffPhase:
+	__slots__ = ("name", "start")
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+
+	def __exit__(self, *exc):
+		sff_stats.addtime(self.name, time.perf_counter() - self.start)
+
+SFF_NOPHASE = contextlib.nullcontext()
+
+#returns context manager that measures phase name, does nothing if statistics is disabled
+def sff_phase(name):
+	if sff_stats == None:
+		return SFF_NOPHASE
+	return SffPhase(name)
+
+#add n to counter name if statistics is enabled
+def sff_count(name, n = 1):
+	if sff_stats != None:
+		sff_stats.count(name, n)
+
+#count one read of length octets
+def sff_countread(length):
+	if sff_stats != None:
+		sff_stats.count("reads")
+		sff_stats.count("read_bytes", length)
+
+#count one write of length octets
+def sff_countwrite(length):
+	if sff_stats != None:
+		sff_stats.count("writes")
+		sff_stats.count("written_bytes", length)
+
+#enable statistics if it is disabled, returns SffStats of current run
+def sff_enablestats():
+	global sff_stats
+	if sff_stats == None:
+		sff_stats = SffStats()
+	return sff_stats
+
+#add hook function (see SffStats) and enable statistics
+def sff_addstatshook(hook):
+	sff_enablestats().hooks.append(hook)
+
+#disable statistics, returns SffStats of finished run (None if it was not enabled)
+def sff_disablestats():
+	global sff_stats
+	r = sff_stats
+	sff_stats = None
+	return r
+
+#Information of one image (subfile) in sff
+#offset: image data offset, size: image data length (0 if linked), x, y: axis,
+#group, image: group# and image#, link: link index (None if not linked),
+#shared: True if image uses shared palette (palette of index 0 image)
+class SubfileRecord:
+	__slots__ = ("offset", "size", "x", "y", "group", "image", "link", "shared")
+
+	def __init__(self, offset, size, x, y, group, image, link, shared):
+		self.offset = offset
+		self.size = size
+		self.x = x
+		self.y = y
+		self.group = group
+		self.image = image
+		self.link = link
+		self.shared = shared
+
+	def copy(self):
+		return SubfileRecord(self.offset, self.size, self.x, self.y, self.group, self.image,
+			self.link, self.shared)
+
+#Columns of SffArchive (attribute name, array typecode). links hold raw link index
+#field (meaningful only if size is 0), flags hold palette mode (1 = shared)
+SFF_COLUMNS = (("offsets", "I"), ("sizes", "I"), ("xs", "h"), ("ys", "h"), ("groups", "H"),
+	("images", "H"), ("links", "H"), ("flags", "B"))
+
+#Read only sff file object backed by mmap. Subheader chain is parsed only once
+#and payloads are handed out as memoryview slices of the mapping, so reading images
+#does not cost any seek/read syscall or copy.
+#Image information is kept in struct of arrays (see SFF_COLUMNS) for bulk queries,
+#sff[i] (or iterating sff) gives SubfileRecord.
+class SffArchive:
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, "rb")
+		sff_count("files_opened")
+		#mmap can not map empty file
+		if os.fstat(self.file.fileno()).st_size == 0:
+			self.map = None
+			self.view = memoryview(b"")
+		else:
+			self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+			self.view = memoryview(self.map)
+		self.count = None
+
+	#parse subheader chain (only once), returns False if fail
+	def parse(self):
+		if self.count != None:
+			return True
+		with sff_phase("parse"):
+			return self.parsechain()
+
+	def parsechain(self):
+		sff = self.view
 		#check read size
-		if len(hdr) < 0x13:
-			print("Fatal: Broken subheader.")
+		if len(sff) < 0x1c:
+			print("Fatal: Broken sff.")
+			return False
+		#Check for header
+		if sff[0:0x10] != b"ElecbyteSpr\0\0\x01\0\x01":
+			print("Fatal: Wrong file identifier.")
+			return False
+		hp =  struct.unpack_from("<LL", sff, 0x14) #image_count, subheader_offset
+		#+0x1c uint32_t (subheader len) seems to be ignored in mugen and assumed 0x20
+		ptr = hp[1] #pointer for subfiles in sff
+		cols = [array.array(t) for n, t in SFF_COLUMNS]
+		aoff, asize, ax, ay, agrp, aimg, alink, aflag = [c.append for c in cols]
+		unpack = struct.Struct("<LLhhHHHB").unpack_from
+		end = len(sff) - 0x13
+		for i in range(hp[0]):
+			#check subheader is in file
+			if ptr > end:
+				print("Fatal: Broken subheader.")
+				return False
+			# next offset, length, X, Y, Group#, Image#, link index, Palette mode
+			nextptr, size, x, y, grp, img, li, pal = unpack(sff, ptr)
+			aoff(ptr + 0x20) #Image offset = subheader addr + subheader size (0x20)
+			asize(size)
+			ax(x)
+			ay(y)
+			agrp(grp)
+			aimg(img)
+			alink(li)
+			aflag(pal)
+			ptr = nextptr #update pointer for reading next subfile
+		self.setcolumns(cols)
+		return True
+
+	#set image information columns (list of arrays in order of SFF_COLUMNS)
+	def setcolumns(self, cols):
+		for k in range(len(SFF_COLUMNS)):
+			setattr(self, SFF_COLUMNS[k][0], cols[k])
+		self.count = len(cols[0])
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		size = self.sizes[i]
+		li = None
+		if size == 0:
+			li = self.links[i]
+		return SubfileRecord(self.offsets[i], size, self.xs[i], self.ys[i], self.groups[i],
+			self.images[i], li, self.flags[i] != 0)
+
+	def __iter__(self):
+		for i in range(self.count):
+			yield self[i]
+
+	#returns list of SubfileRecord of all images (for editing)
+	def records(self):
+		return list(self)
+
+	#get (group, image) index of this sff from sidecar file, rebuild it if it is stale.
+	#if there is no sidecar file, build it only when create is True, otherwise returns None.
+	#image information is loaded from index if possible (no need to walk subheader chain).
+	#if force is True, index is always rebuilt (size and mtime may not change by rewrite)
+	def getindex(self, create, force = False):
+		idxname = sff_indexpath(self.path)
+		st = os.fstat(self.file.fileno())
+		if not create and not os.path.exists(idxname):
 			return None
-		# next offset, length, X, Y, Group#, Image#, link index, Palette mode
-		p = struct.unpack("<LLhhHHH?", hdr)
-		imgoff = ptr + 0x20 #Image offset = subheader addr + subheader size (0x20)
-		if p[1] == 0:
-			li = p[6]
+		with sff_phase("index"):
+			idx = None
+			if not force:
+				idx = sff_loadindex(idxname, self, st.st_size, st.st_mtime_ns)
+			if idx == None:
+				#missing or stale, rebuild from subheader chain
+				if not self.parse():
+					return None
+				idx = SffIndex(self)
+				try:
+					sff_writeindex(idxname, idx, st.st_size, st.st_mtime_ns)
+					print(f"Index file {idxname} updated.")
+				except(OSError):
+					#index is only cache, use it without saving (read only directory etc.)
+					print(f"Index file {idxname} write failed, index is not saved.")
+		return idx
+
+	#returns memoryview of length octets from off, it will be shorter than length
+	#if file is truncated
+	def read(self, off, length):
+		r = self.view[off:off + length]
+		sff_countread(len(r))
+		return r
+
+	#returns stored data of image in index i (empty for linked image)
+	def payload(self, i):
+		return self.read(self.offsets[i], self.sizes[i])
+
+	#tell kernel that mapping is accessed randomly (no readahead), for reading only small
+	#parts of many images
+	def adviserandom(self):
+		if self.map != None and hasattr(self.map, "madvise"):
+			self.map.madvise(mmap.MADV_RANDOM)
+
+	def close(self):
+		self.view.release()
+		if self.map != None:
+			try:
+				self.map.close()
+			except(BufferError):
+				#payload views are still alive, mapping will be freed with them
+				pass
+		self.file.close()
+
+#SFF index sidecar file (sfffile.idx) format
+#Header: "SFFIDX\0\x02", uint64_t sff size, uint64_t sff mtime (ns), uint32_t image count,
+#uint32_t hash table bits
+#Columns: image count * each column of SFF_COLUMNS (image offset, length, x, y, group#,
+#image#, link index, palette mode)
+#Sorted keys: image count * uint32_t (group# << 16 | image#)
+#Sorted order: image count * uint32_t (image index of each sorted key)
+#Hash table: (1 << bits) * uint32_t (image index + 1, 0 means empty), linear probing
+#All numbers are in native byte order (index is cache of local machine)
+SFFIDX_MAGIC = b"SFFIDX\0\x02"
+SFFIDX_HEADER = "<8sQQLL"
+
+#get index sidecar file name of sffname
+def sff_indexpath(sffname):
+	return f"{sffname}.idx"
+
+#(group, image) index of sff (SffArchive that is parsed or loaded from index)
+class SffIndex:
+	def __init__(self, sff, keys = None, order = None, bits = None, table = None):
+		self.sff = sff
+		if keys == None:
+			#build sorted key list and hash table
+			n = len(sff)
+			allkeys = [(g << 16) | i for g, i in zip(sff.groups, sff.images)]
+			order = array.array("I", sorted(range(n), key = allkeys.__getitem__))
+			keys = array.array("I", (allkeys[i] for i in order))
+			bits = 4
+			while (1 << bits) < n * 2:
+				bits += 1
+			table = array.array("I", bytes(4 << bits))
+			mask = (1 << bits) - 1
+			for i in range(n):
+				slot = self.hashslot(allkeys[i], bits)
+				while table[slot] != 0:
+					slot = (slot + 1) & mask
+				table[slot] = i + 1
+		self.keys = keys
+		self.order = order
+		self.bits = bits
+		self.table = table
+
+	#fibonacci hashing of key into bits wide slot number
+	@staticmethod
+	def hashslot(key, bits):
+		return ((key * 2654435761) & 0xffffffff) >> (32 - bits)
+
+	#returns list of image indexes that have group# grp and image# img
+	def lookup(self, grp, img):
+		mask = (1 << self.bits) - 1
+		slot = self.hashslot((grp << 16) | img, self.bits)
+		groups = self.sff.groups
+		images = self.sff.images
+		r = []
+		while self.table[slot] != 0:
+			i = self.table[slot] - 1
+			if groups[i] == grp and images[i] == img:
+				r.append(i)
+			slot = (slot + 1) & mask
+		return sorted(r)
+
+	#returns sorted list of image indexes selected by selector (SffSelector)
+	def select(self, selector):
+		n = len(self.sff)
+		if selector.i != None:
+			return selector.scan(n, None, None)
+		if selector.g == None:
+			return list(range(n))
+		nranges = selector.n
+		if nranges == None:
+			nranges = [(0, 65535)]
+		#point lookups by hash table
+		if len(selector.g) * len(nranges) <= 64 and \
+			all(lo == hi for lo, hi in selector.g + nranges):
+			r = []
+			for g, _ in selector.g:
+				for k, _ in nranges:
+					r.extend(self.lookup(g, k))
+			return sorted(r)
+		#range lookups by bisect, one for each group if image# is specified
+		if selector.n == None:
+			ranges = [(lo << 16, (hi << 16) | 0xffff) for lo, hi in selector.g]
 		else:
-			li = None
-		#image offset, size, x, y, group#, image#, link index, palette mode
-		img_info.append([imgoff, p[1], p[2], p[3], p[4], p[5], li, p[7]])
-		ptr = p[0] #update pointer for reading next subfile
-	return img_info
-
-#reconstruct sff by originalsff file object and new image information list fixedinfo
-def sff_reconstruct(sffname, originalsff, fixedinfo):
-	tmpsff = tempfile.TemporaryFile()
-	ptr = 0x200
-	c = 0
-	#write subheader and files
-	for i in fixedinfo:
-		#skip if deleted
-		if i == None:
+			#too many ranges, scanning columns is faster
+			if sum(hi - lo + 1 for lo, hi in selector.g) * len(nranges) > n:
+				return selector.scan(n, self.sff.groups, self.sff.images)
+			ranges = [((g << 16) | lo, (g << 16) | hi) for glo, ghi in selector.g
+				for g in range(glo, ghi + 1) for lo, hi in nranges]
+		r = []
+		for lo, hi in ranges:
+			a = bisect.bisect_left(self.keys, lo)
+			b = bisect.bisect_right(self.keys, hi)
+			r.extend(self.order[a:b])
+		return sorted(r)
+
+#write index idx into sidecar file idxname, sffsize and sffmtime are size and mtime of sff
+def sff_writeindex(idxname, idx, sffsize, sffmtime):
+	sff = idx.sff
+	hdr = struct.pack(SFFIDX_HEADER, SFFIDX_MAGIC, sffsize, sffmtime, len(sff), idx.bits)
+	cols = [getattr(sff, n) for n, t in SFF_COLUMNS]
+	#write into temporary file then rename, reader never sees half written index
+	tmpname = f"{idxname}.tmp"
+	try:
+		writebin(tmpname, hdr, *cols, idx.keys, idx.order, idx.table)
+		os.replace(tmpname, idxname)
+	except(OSError):
+		if os.path.isfile(tmpname):
+			os.remove(tmpname)
+		raise
+
+#load index sidecar file idxname of sff (SffArchive), returns None if it does not exist,
+#broken or does not match sffsize and sffmtime (stale). image information columns of sff
+#are set from index.
+def sff_loadindex(idxname, sff, sffsize, sffmtime):
+	try:
+		f = open(idxname, "rb")
+	except(IOError):
+		return None
+	d = f.read()
+	f.close()
+	sff_count("files_opened")
+	sff_countread(len(d))
+	hlen = struct.calcsize(SFFIDX_HEADER)
+	if len(d) < hlen:
+		return None
+	magic, size, mtime, n, bits = struct.unpack_from(SFFIDX_HEADER, d)
+	if magic != SFFIDX_MAGIC or size != sffsize or mtime != sffmtime:
+		return None
+	#split into arrays
+	types = [t for name, t in SFF_COLUMNS] + ["I", "I"]
+	l = [n * array.array(t).itemsize for t in types] + [4 << bits]
+	if len(d) != hlen + sum(l):
+		return None
+	r = []
+	ptr = hlen
+	for t, k in zip(types + ["I"], l):
+		r.append(array.array(t, d[ptr:ptr + k]))
+		ptr += k
+	sff.setcolumns(r[:len(SFF_COLUMNS)])
+	return SffIndex(sff, r[-3], r[-2], bits, r[-1])
+
+#update index sidecar file of sffname to match current sffname content,
+#only if it exists or create is True. if force is True, index is rebuilt even if it looks
+#up to date (use after sffname is modified in place or rewritten)
+def sff_updateindex(sffname, create, force = False):
+	if not create and not os.path.exists(sff_indexpath(sffname)):
+		return
+	sff = SffArchive(sffname)
+	sff.getindex(True, force)
+	sff.close()
+
+#returns sorted list of image indexes of sff (parsed SffArchive) selected by selector,
+#use index idx if it is not None
+def sff_selectimages(sff, idx, selector):
+	if idx != None:
+		return idx.select(selector)
+	return selector.scan(len(sff), sff.groups, sff.images)
+
+#copy length octets from srcoff of SffArchive src to dstoff of file descriptor dst.
+#data is copied inside kernel by copy_file_range (or sendfile) if possible,
+#falls back to writing mapped view.
+def sff_copyrange(src, dst, srcoff, length, dstoff):
+	global copy_file_range_ok, sendfile_ok
+	srcfd = src.file.fileno()
+	sff_countread(length)
+	sff_countwrite(length)
+	end = srcoff + length
+	while srcoff < end and copy_file_range_ok:
+		try:
+			r = os.copy_file_range(srcfd, dst, end - srcoff, srcoff, dstoff)
+		except(AttributeError, OSError):
+			#not supported by python, kernel or filesystem
+			copy_file_range_ok = False
+			break
+		if r == 0:
+			return #source is truncated
+		srcoff += r
+		dstoff += r
+	while srcoff < end and sendfile_ok:
+		try:
+			os.lseek(dst, dstoff, os.SEEK_SET)
+			r = os.sendfile(dst, srcfd, srcoff, end - srcoff)
+		except(AttributeError, OSError):
+			sendfile_ok = False
+			break
+		if r == 0:
+			return
+		srcoff += r
+		dstoff += r
+	if srcoff < end:
+		os.pwrite(dst, src.view[srcoff:end], dstoff)
+
+copy_file_range_ok = True
+sendfile_ok = True
+
+#returns list of 16 octets hash of image data of each SubfileRecord in records
+#(in sff: SffArchive)
+def sff_hashrecords(sff, records):
+	#hash mapped data in thread pool (hashlib releases GIL while hashing)
+	def hashchunk(chunk):
+		r = []
+		for e in chunk:
+			r.append(hashlib.blake2b(sff.read(e.offset, e.size), digest_size = 16).digest())
+		return r
+	chunks = [records[i:i + 256] for i in range(0, len(records), 256)]
+	digests = []
+	with concurrent.futures.ThreadPoolExecutor() as ex:
+		for r in ex.map(hashchunk, chunks):
+			digests.extend(r)
+	return digests
+
+#find images in sff (SffArchive) that have exactly same content and palette mode,
+#and change them into link to first one. records (list of SubfileRecord) is modified,
+#returns linked count.
+def sff_linkduplicates(sff, records):
+	targets = [e for e in records if e.size != 0]
+	digests = sff_hashrecords(sff, targets)
+	index = {id(records[i]): i for i in range(len(records))}
+	first = {} #(digest, size, palette mode) -> first image
+	redirect = {} #duplicate image index -> first image index
+	for e, d in zip(targets, digests):
+		k = (d, e.size, e.shared)
+		if k not in first:
+			first[k] = e
 			continue
-		filelen = i[1]
-		data = b""
-		#if not linked, read original content
-		if filelen != 0:
-			originalsff.seek(i[0]) #seek to image file offset
-			data = originalsff.read(filelen) #read pcx
-		nextptr = sff_getoptimaloffset(ptr, filelen) #get optimal next subheader offset
-		#prepare subheader
-		hdr = sff_generatesubheader(nextptr, filelen, i[2], i[3], i[4], i[5], i[6], i[7])
-		#write subheader + file
-		tmpsff.seek(ptr)
-		tmpsff.write(hdr + data)
-		ptr = nextptr
-		c = c + 1
-	sff_writeheader(tmpsff, c) #write header
+		f = first[k]
+		#make sure it is not hash collision
+		if sff.read(e.offset, e.size) != sff.read(f.offset, f.size):
+			continue
+		e.size = 0
+		e.link = index[id(f)]
+		redirect[index[id(e)]] = e.link
+	#images that were linked to duplicates have to be linked to first one
+	for e in records:
+		if e.size == 0 and e.link in redirect:
+			e.link = redirect[e.link]
+	return len(redirect)
+
+#autocrop all images in sff (SffArchive), records (list of SubfileRecord) is modified
+#(size and axis). returns dict of image index -> new image data
+def sff_autocropall(sff, records):
+	payloads = {}
+	linkers = {} #image index -> images linked to it
+	for e in records:
+		if e.size == 0:
+			linkers.setdefault(e.link, []).append(e)
+	for i in range(len(records)):
+		e = records[i]
+		if e.size == 0:
+			continue
+		data, x, y, crop = sff_autocrop(sff.read(e.offset, e.size), e.x, e.y)
+		if crop == None:
+			continue
+		#linked images share cropped data, their axis have to be moved too
+		l = linkers.get(i, [])
+		if not all(sff_checkaxis(k.x - crop[0], k.y - crop[1]) for k in l):
+			continue
+		for k in l:
+			k.x -= crop[0]
+			k.y -= crop[1]
+		payloads[i] = data
+		e.size = len(data)
+		e.x = x
+		e.y = y
+	return payloads
+
+#find images in sff (SffArchive) that have same palette as index0 image (shared palette),
+#then set shared palette mode and remove palette from them. records (list of SubfileRecord)
+#is modified and new image data are set into payloads (dict of image index -> new image data,
+#data in it is used instead of sff). returns changed count.
+def sff_sharepalettes(sff, records, payloads):
+	#returns current image data of image index i
+	def getdata(i):
+		if i in payloads:
+			return payloads[i]
+		return sff.read(records[i].offset, records[i].size)
+	if len(records) == 0 or records[0].size == 0:
+		return 0
+	first = getdata(0)
+	if not pcx_haspalette(first):
+		return 0
+	palette = first[-768:]
+	changed = set()
+	for i in range(1, len(records)):
+		e = records[i]
+		if e.size == 0:
+			continue
+		data = getdata(i)
+		#compare palette trailer (768 octets after palette indicator)
+		if not pcx_haspalette(data) or data[-768:] != palette:
+			continue
+		payloads[i] = data[:-769]
+		e.size = len(payloads[i])
+		e.shared = True
+		changed.add(i)
+	#linked images share data without palette now
+	for e in records:
+		if e.size == 0 and e.link in changed:
+			e.shared = True
+	return len(changed)
+
+#reconstruct sff by originalsff (SffArchive) and new image list fixedinfo
+#(list of SubfileRecord, None means deleted image)
+#payloads is dict of fixedinfo index -> new image data, that replaces original image data
+#(image data can be function that returns image data, it is called when image is written)
+#new sff is streamed into temporary file in same directory and swapped with
+#original sff atomically, so memory usage does not depend on sff size and original
+#sff is untouched if something goes wrong.
+def sff_reconstruct(sffname, originalsff, fixedinfo, payloads = {}):
+	#permission of original sff is kept, original sff is swapped with new one at the end
+	with SffReplaceFile(sffname, buffering = 0) as tmpsff:
+		fd = tmpsff.fileno()
+		ptr = 0x200
+		c = 0
+		#write subheader and files
+		with sff_phase("write"):
+			for n in range(len(fixedinfo)):
+				i = fixedinfo[n]
+				#skip if deleted
+				if i == None:
+					continue
+				filelen = i.size
+				data = None
+				if n in payloads:
+					data = payloads[n]
+					if callable(data):
+						data = data()
+					filelen = len(data)
+				nextptr = sff_getoptimaloffset(ptr, filelen) #get optimal next subheader offset
+				#prepare subheader
+				hdr = sff_generatesubheader(nextptr, filelen, i.x, i.y, i.group, i.image, i.link,
+					i.shared)
+				#write subheader, then copy file (if not linked) from original sff
+				os.pwrite(fd, hdr, ptr)
+				sff_countwrite(0x20)
+				if data != None:
+					os.pwrite(fd, data, ptr + 0x20)
+					sff_countwrite(filelen)
+				elif filelen != 0:
+					sff_copyrange(originalsff, fd, i.offset, filelen, ptr + 0x20)
+				sff_count("sprites")
+				ptr = nextptr
+				c = c + 1
+		sff_writeheader(tmpsff, c) #write header
 	originalsff.close() #close original sff
-	#overwrite original sff with tmpsff
-	tmpsff.seek(0)
-	writebin(sffname, tmpsff.read())
-	tmpsff.close() #close new sff
+	sff_updateindex(sffname, False, True)
+
+#write files in thread pool of workers threads (None: default count), jobs is iterable
+#of (message, filename, chunks) and filename can be None for message only job.
+#messages and errors are printed in job order, returns count of files failed to write.
+def sff_writefiles(jobs, workers):
+	if workers == None:
+		workers = min(32, (os.cpu_count() or 1) + 4)
+	failed = 0
+	pending = collections.deque()
+	#print message of finished job, or error if it failed
+	def finish():
+		msg, fname, fut = pending.popleft()
+		if fut != None:
+			try:
+				fut.result()
+			except(IOError):
+				print(f"Fatal: {fname} write failed!")
+				return 1
+		print(msg)
+		return 0
+	with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+		for msg, fname, chunks in jobs:
+			fut = None
+			if fname != None:
+				fut = ex.submit(writebin, fname, *chunks)
+			pending.append((msg, fname, fut))
+			#keep number of queued jobs bounded
+			if len(pending) > workers * 4:
+				failed += finish()
+		while len(pending) != 0:
+			failed += finish()
+	return failed
 
 def list_mode():
 	if len(sys.argv) < 3:
@@ -360,91 +1171,270 @@ def list_mode():
 		return 1
 	#Try opening sff file.
 	try:
-		sff = open(sys.argv[2], "rb")
+		sff = SffArchive(sys.argv[2])
 	except(IOError):
 		print("SFF open failed")
 		return 2
-	img_info = sff_getinfo(sff)
-	if img_info == None:
+	idx = sff.getindex(getoption("-I") != None)
+	if not sff.parse():
+		sff.close()
 		return 3
+	selected = set(sff_selectimages(sff, idx, selector))
 	#show information + insanity check
-	i = len(img_info)
+	i = len(sff)
 	print(f"Total {i} images.")
+	dead = len(sff.view) - sff_getcompactsize(sff.sizes)
+	if dead > 0:
+		print(f"Dead space: {dead} octets.")
 	insanity = False
-	for i in range(len(img_info)):
-		e = img_info[i]
-		#extract params
-		imgoff = e[0]
-		imglen = e[1]
-		px = e[2]
-		py = e[3]
-		grp = e[4]
-		img = e[5]
-		li = e[6]
-		#if it was linked image...
-		if li != None:
-		#read linked destination image offset if linked index is not wrong
-			if li >= len(img_info):
-				print(f"Insanity: {i}: link id exceeds image count - 1")
-				insanity = True
-				imgoff = 0
-			else:
-				imgoff = img_info[li][0]
-				imglen = img_info[li][1]
-			if i == 0:
-				print(f"Insanity: Index0 image is not actual!")
-				insanity = True
-		ix = -1
-		iy = -1
-		if imgoff != 0:
-			#read image
-			sff.seek(imgoff)
-			d = sff.read(imglen)
-			#check size
-			if len(d) < imglen:
-				t = len(d)
-				print(f"Insanity: {i}: Wrong pcx file size: Size={imglen} Read={t}")
-				insanity = True
-			if len(d) > 0x42:
-				#check for image type and identifier
-				if d[0] != 0xa or d[3] != 8 or d[0x41] != 1:
-					print(f"Insanity: {i}: PCX file identifier mismatch or not a 256 indexed color.")
+	#read only pcx header and palette indicator of each image in file order, instead of
+	#whole image data. (offset, length) -> (header, readable length, has palette)
+	heads = {}
+	sff.adviserandom()
+	with sff_phase("read"):
+		for off, size in sorted(set(zip(sff.offsets, sff.sizes))):
+			if size == 0:
+				continue
+			avail = max(0, min(size, len(sff.view) - off))
+			pal = avail >= 769 and sff.read(off + avail - 769, 1)[0] == 12
+			heads[(off, size)] = (bytes(sff.read(off, min(avail, 0x80))), avail, pal)
+	with sff_phase("check"):
+		for i in range(len(sff)):
+			e = sff[i]
+			sff_count("sprites")
+			#extract params
+			imgoff = e.offset
+			imglen = e.size
+			px = e.x
+			py = e.y
+			grp = e.group
+			img = e.image
+			li = e.link
+			#if it was linked image...
+			if li != None:
+			#read linked destination image offset if linked index is not wrong
+				if li >= len(sff):
+					print(f"Insanity: {i}: link id exceeds image count - 1")
 					insanity = True
+					imgoff = 0
 				else:
-					ix, iy = struct.unpack("<HH", d[8:0xc]) #read image size width, height
-			else:
-				#if filesize is shorter than header size
-				print(f"Insanity: {i}: PCX too short!")
-				insanity = True
-			#Next, check for palette availability for index=0 image or non shared palette
-			if (i == 0 or e[7] == 0) and not pcx_haspalette(d):
-				print(f"Insanity: {i}: Non shared palette image, but there is no palette in PCX.")
-				insanity = True
-		#Show information
-		itemselected = decodeselectionfilter(selector, i, grp, img)
-		if itemselected:
-			print(f"{i}: Group{grp} Image{img} Pos={px}x{py} Size={ix}x{iy}", end = "")
-			if e[7] == 1:
-				print(" Shared", end = "")
-			if li != None:
-				print(f" Linked to {li}", end = "")
-			print()
+					imgoff = sff.offsets[li]
+					imglen = sff.sizes[li]
+				if i == 0:
+					print(f"Insanity: Index0 image is not actual!")
+					insanity = True
+			ix = -1
+			iy = -1
+			if imgoff != 0:
+				d, t, haspal = heads.get((imgoff, imglen), (b"", 0, False))
+				#check size
+				if t < imglen:
+					print(f"Insanity: {i}: Wrong pcx file size: Size={imglen} Read={t}")
+					insanity = True
+				if len(d) > 0x42:
+					#check for image type and identifier
+					if d[0] != 0xa or d[3] != 8 or d[0x41] != 1:
+						print(f"Insanity: {i}: PCX file identifier mismatch or not a 256 indexed color.")
+						insanity = True
+					else:
+						ix, iy = struct.unpack("<HH", d[8:0xc]) #read image size width, height
+				else:
+					#if filesize is shorter than header size
+					print(f"Insanity: {i}: PCX too short!")
+					insanity = True
+				#Next, check for palette availability for index=0 image or non shared palette
+				if (i == 0 or not e.shared) and not haspal:
+					print(f"Insanity: {i}: Non shared palette image, but there is no palette in PCX.")
+					insanity = True
+			#Show information
+			if i in selected:
+				print(f"{i}: Group{grp} Image{img} Pos={px}x{py} Size={ix}x{iy}", end = "")
+				if e.shared:
+					print(" Shared", end = "")
+				if li != None:
+					print(f" Linked to {li}", end = "")
+				print()
 	sff.close()
 	if insanity:
 		return 4
 	print("Have a nice day")
 	return 0
 
+#check structure (subheader chain, image data ranges, links, numbers) of sff (parsed
+#SffArchive), returns list of (image index, message) of problems
+def sff_verifystructure(sff):
+	r = []
+	#subheaders and image data must not overlap each other and header
+	ranges = sorted((sff.offsets[i] - 0x20, sff.offsets[i] + sff.sizes[i], i) for i in range(len(sff)))
+	end = 0x200
+	last = None
+	for start, stop, i in ranges:
+		if start < end:
+			if last == None:
+				r.append((i, "Subheader overlaps sff header."))
+			else:
+				r.append((i, f"Subheader or image data overlaps image {last}."))
+		if stop > end:
+			end = stop
+			last = i
+	used = {} #(group, image) -> first image index
+	for i in range(len(sff)):
+		k = (sff.groups[i], sff.images[i])
+		if k in used:
+			r.append((i, f"Group{k[0]} Image{k[1]} is already used by image {used[k]}."))
+		else:
+			used[k] = i
+		if sff.sizes[i] != 0:
+			continue
+		li = sff.links[i]
+		if i == 0:
+			r.append((i, "Index0 image is not actual!"))
+		elif li >= len(sff):
+			r.append((i, "link id exceeds image count - 1"))
+		elif li == i:
+			r.append((i, "Linked to itself."))
+		elif li > i:
+			#mugen loads images in order, link destination is not loaded yet
+			r.append((i, f"Linked to later image {li}."))
+		elif sff.sizes[li] == 0:
+			r.append((i, f"Linked to linked image {li}."))
+	return r
+
+#fully check images of jobs (list of (image index, offset, size, palette is required)) in
+#sff file path, returns list of (image index, message) of problems. runs in worker process
+def sff_verifyimages(path, jobs):
+	sff = SffArchive(path)
+	r = []
+	for i, off, size, needpal in jobs:
+		d = sff.read(off, size)
+		if len(d) < size:
+			r.append((i, f"Wrong pcx file size: Size={size} Read={len(d)}"))
+			continue
+		if pcx_getinfo(d) == None:
+			r.append((i, "PCX file identifier mismatch or not a 256 indexed color."))
+			continue
+		if needpal and not pcx_haspalette(d):
+			r.append((i, "Non shared palette image, but there is no palette in PCX."))
+		t = pcx_decode(d)
+		if t == None and not needpal and pcx_haspalette(d):
+			#0xc at -769 of image without palette may be RLE data, decode whole data as image
+			t = pcx_decode(bytes(d) + b"\x0c" + bytes(768))
+		if t == None:
+			r.append((i, "PCX RLE data does not have width x height pixels."))
+	d = None
+	sff.close()
+	return r
+
+#returns list of sff files in paths (files and directories searched recursively)
+def sff_verifytargets(paths):
+	r = []
+	for p in paths:
+		if not os.path.isdir(p):
+			r.append(p)
+			continue
+		for root, dirs, files in os.walk(p):
+			dirs.sort()
+			for f in sorted(files):
+				if f.lower().endswith(".sff"):
+					r.append(os.path.join(root, f))
+	return r
+
+def verify_mode():
+	if len(sys.argv) < 3:
+		print(HELPMSG_VERIFY)
+		return 1
+	jobs = os.cpu_count() or 1
+	paths = []
+	args = iter(sys.argv[2:])
+	for a in args:
+		if a == "-j":
+			try:
+				jobs = int(next(args, ""))
+			except(ValueError):
+				jobs = 0
+			if jobs <= 0:
+				print("-j: Must be number larger than 0")
+				return 1
+		elif a == "--stats-json":
+			next(args, None)
+		elif a[:1] != "-":
+			paths.append(os.path.expanduser(a))
+	targets = sff_verifytargets(paths)
+	if len(targets) == 0:
+		print("Fatal: No sff files found.")
+		return 1
+	#check structure of every file and queue image checks, chunks are decoded in parallel
+	results = [] #(path, image count, list of problems or None if sff can not be parsed)
+	chunks = [] #(index in results, future or job list)
+	ex = None
+	if jobs > 1:
+		ex = concurrent.futures.ProcessPoolExecutor(jobs)
+	try:
+		for path in targets:
+			try:
+				sff = SffArchive(path)
+			except(IOError):
+				print(f"{path}: open failed")
+				results.append((path, 0, None))
+				continue
+			if not sff.parse():
+				sff.close()
+				results.append((path, 0, None))
+				continue
+			with sff_phase("check"):
+				problems = sff_verifystructure(sff)
+			results.append((path, len(sff), problems))
+			sff_count("sprites", len(sff))
+			todo = []
+			for i in range(len(sff)):
+				if sff.sizes[i] != 0:
+					todo.append((i, sff.offsets[i], sff.sizes[i], i == 0 or sff.flags[i] == 0))
+			sff.close()
+			for k in range(0, len(todo), 256):
+				if ex == None:
+					with sff_phase("decode"):
+						problems.extend(sff_verifyimages(path, todo[k:k + 256]))
+				else:
+					chunks.append((len(results) - 1, ex.submit(sff_verifyimages, path, todo[k:k + 256])))
+		with sff_phase("decode"):
+			for n, fut in chunks:
+				results[n][2].extend(fut.result())
+	finally:
+		if ex != None:
+			ex.shutdown()
+	#report in file and image index order
+	bad = 0
+	images = 0
+	for path, count, problems in results:
+		images += count
+		if problems == None:
+			print(f"Insanity: {path}: Not a valid sff v1 file.")
+			bad += 1
+			continue
+		problems.sort(key = lambda e: e[0])
+		for i, msg in problems:
+			print(f"Insanity: {path}: {i}: {msg}")
+		if len(problems) != 0:
+			bad += 1
+		print(f"{path}: {count} images, {len(problems)} problems.")
+	print(f"Verified {len(results)} files ({images} images), {bad} files have problems.")
+	if bad != 0:
+		return 4
+	print("Have a nice day")
+	return 0
+
 def extract_mode():
 	if len(sys.argv) < 4:
 		print(HELPMSG_EXTRACT)
 		return 1
 	selector = getselectionfilter() #get selector option
+	if selector == None:
+		return 1
 	detailed_filename = getoption("-f")
 	palette_extract = getoption("-p")
 	#Try opening sff file
 	try:
-		sff = open(sys.argv[2], "rb")
+		sff = SffArchive(sys.argv[2])
 	except(IOError):
 		print("SFF open failed")
 		return 2
@@ -454,191 +1444,710 @@ def extract_mode():
 		print(f"Fatal: Output destination {outdir} already exists!")
 		sff.close()
 		return 1
+	idx = sff.getindex(getoption("-I") != None)
+	if not sff.parse():
+		sff.close()
+		return 3
+	jobs = None
+	if getoption("-j") != None:
+		try:
+			jobs = int(getoption("-j"))
+		except(ValueError):
+			jobs = 0
+		if jobs <= 0:
+			print("-j: Must be number larger than 0")
+			sff.close()
+			return 1
 	os.mkdir(outdir)
-	image_list = sff_getinfo(sff)
+	selected = sff_selectimages(sff, idx, selector)
+	#First pass: get palette from image located on top of sff (shared palette)
 	shared_palette = b""
-	for i in range(len(image_list)):
-		e = image_list[i]
-		px = e[2]
-		py = e[3]
-		grp = e[4]
-		imgno = e[5]
-		#if image is not selected, skip (always process image[0])
-		itemselected = decodeselectionfilter(selector, i, grp, imgno)
-		if not itemselected and i != 0:
-			continue
-		#do not extract linked image
-		if e[6] != None:
-			li = e[6]
-			print(f"{i}: Not extracting: linked to {li}")
-			continue
-		#get file content
-		sff.seek(e[0]) #jump to image offset
-		data = sff.read(e[1])
-		#Get palette from image located on top of sff
-		if pcx_haspalette(data) and i == 0:
-			shared_palette = data[-769:]
-			#If palette extract option is on
-			if palette_extract != None:
-				print("Extracting palette")
-				#write except first palette indicator.
-				writebin(f"{outdir}/shared.act", shared_palette[1:])
-		#extract into single file
-		#change palette if image is stored in shared palette mode
-		if e[7] == 1:
-			#if it has palette already, clear it
+	with sff_phase("palette"):
+		if len(sff) != 0 and sff.sizes[0] != 0:
+			data = sff.payload(0)
 			if pcx_haspalette(data):
-				data = data[:-769]
-			data = data + shared_palette
-		filename = f"{i}"
-		#if detailed filename flag is on
-		if detailed_filename != None:
-			filename = f"{i}_{grp}_{imgno}_{px}_{py}"
-			if e[7] == 1:
-				filename += "_shared"
-		if itemselected:
-			print(f"Extracted: {i}: Group{grp} Image{imgno} -> {outdir}/{filename}.pcx")
-			writebin(f"{outdir}/{filename}.pcx", data)
+				shared_palette = data[-769:]
+	#Second pass: write files in thread pool
+	def extractjobs():
+		#If palette extract option is on
+		if palette_extract != None and len(shared_palette) != 0:
+			#write except first palette indicator.
+			yield ("Extracting palette", f"{outdir}/shared.act", (shared_palette[1:], ))
+		for i in selected:
+			e = sff[i]
+			px = e.x
+			py = e.y
+			grp = e.group
+			imgno = e.image
+			#do not extract linked image
+			if e.link != None:
+				li = e.link
+				yield (f"{i}: Not extracting: linked to {li}", None, None)
+				continue
+			#get file content (mapped view, no copy)
+			data = sff.read(e.offset, e.size)
+			sff_count("sprites")
+			#extract into single file
+			#change palette if image is stored in shared palette mode
+			pal = b""
+			if e.shared:
+				with sff_phase("palette"):
+					#if it has palette already, clear it
+					if pcx_haspalette(data):
+						data = data[:-769]
+					pal = shared_palette
+			filename = f"{i}"
+			#if detailed filename flag is on
+			if detailed_filename != None:
+				filename = f"{i}_{grp}_{imgno}_{px}_{py}"
+				if e.shared:
+					filename += "_shared"
+			yield (f"Extracted: {i}: Group{grp} Image{imgno} -> {outdir}/{filename}.pcx",
+				f"{outdir}/{filename}.pcx", (data, pal))
+	with sff_phase("write"):
+		failed = sff_writefiles(extractjobs(), jobs)
+	data = shared_palette = None
 	sff.close()
+	if failed != 0:
+		print(f"Fatal: {failed} files could not be written!")
+		return 3
 	print("SFF extract finished. Have a nice day.")
 	return 0
 
-def create_mode():
-	#if there is no sfffile option and infiledir show help and exit
+#returns True if args (command line) writes data into stdout, messages have to go to stderr
+def sff_datatostdout(args):
+	return len(args) > 3 and args[1] == "e" and args[3] == "-"
+
+#returns (filename, data chunks) of images of selected (list of image indexes) in sff
+#(parsed SffArchive) for export, first one is filelist of create mode (made from subheaders,
+#so importer does not have to keep images until filelist comes).
+#images in shared palette mode get palette of index0 image like extract mode.
+#detailed: use detailed filename, sharedact: add shared palette as shared.act
+def sff_exportentries(sff, selected, detailed, sharedact):
+	#First pass: filenames and filelist
+	names = {} #actual image index -> exported filename
+	exports = [] #(image index, actual image index) in export order
+	filelist = []
+	for i in selected:
+		e = sff[i]
+		a = sff_resolvelink(sff, i)
+		if a == None:
+			exports.append((i, None))
+			continue
+		#image data is exported once as file of actual image
+		if a not in names:
+			filename = f"{a}"
+			if detailed:
+				filename = f"{a}_{sff.groups[a]}_{sff.images[a]}_{sff.xs[a]}_{sff.ys[a]}"
+				if sff.flags[a]:
+					filename += "_shared"
+			names[a] = f"{filename}.pcx"
+		exports.append((i, a))
+		filelist.append(f"{names[a]}\n{e.group} {e.image} {e.x} {e.y}{' shared' if e.shared else ''}\n")
+	yield ("filelist", ("".join(filelist).encode(), ))
+	shared_palette = b""
+	with sff_phase("palette"):
+		if len(sff) != 0 and sff.sizes[0] != 0:
+			data = sff.payload(0)
+			if pcx_haspalette(data):
+				shared_palette = bytes(data[-769:])
+	if sharedact and len(shared_palette) != 0:
+		yield ("shared.act", (shared_palette[1:], ))
+	#Second pass: image data
+	done = set()
+	for i, a in exports:
+		if a == None:
+			print(f"{i}: Not exporting: broken link")
+			continue
+		if a not in done:
+			done.add(a)
+			t = sff[a]
+			data = sff.payload(a)
+			sff_count("sprites")
+			pal = b""
+			if t.shared:
+				with sff_phase("palette"):
+					#if it has palette already, clear it
+					if pcx_haspalette(data):
+						data = data[:-769]
+					pal = shared_palette
+			print(f"Exported: {a}: Group{t.group} Image{t.image} -> {names[a]}")
+			yield (names[a], (data, pal))
+		if a != i:
+			print(f"{i}: Linked to {names[a]}")
+
+#write entries (iterable of (filename, data chunks)) into archive of fmt ("tar" or "zip")
+#to binary stream out sequentially (out does not have to be seekable), mtime is
+#modification time of entries
+def sff_writearchive(out, fmt, entries, mtime):
+	if fmt == "zip":
+		arc = zipfile.ZipFile(out, "w", zipfile.ZIP_STORED)
+		for name, chunks in entries:
+			info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+			with arc.open(info, "w") as f:
+				for c in chunks:
+					f.write(c)
+					sff_countwrite(len(c))
+		arc.close()
+		return
+	arc = tarfile.open(fileobj = out, mode = "w|", format = tarfile.USTAR_FORMAT)
+	for name, chunks in entries:
+		info = tarfile.TarInfo(name)
+		info.size = sum(len(c) for c in chunks)
+		info.mtime = mtime
+		info.mode = 0o644
+		arc.addfile(info, io.BytesIO(b"".join(chunks)))
+		sff_countwrite(info.size)
+	arc.close()
+
+def export_mode():
 	if len(sys.argv) < 4:
-		print(HELPMSG_CREATE)
+		print(HELPMSG_EXPORT)
 		return 1
-	#check for parameters
-	m_autocrop = getoption("-c")
-	if m_autocrop != None:
-		print("Sorry: Autocrop is not implemented yet!")
+	selector = getselectionfilter()
+	if selector == None:
 		return 1
-	m_linkmode = getoption("-f")
-	m_removepal = getoption("-p")
-	indir = os.path.expanduser(sys.argv[3]) #input directory
-	sfffile = os.path.expanduser(sys.argv[2]) #target sff file
-	#directory existence check
-	if not os.path.exists(indir):
-		print(f"Fatal: input directory {indir} not found!")
+	outfile = sys.argv[3]
+	fmt = getoption("-T")
+	if fmt == None:
+		fmt = "zip" if outfile.lower().endswith(".zip") else "tar"
+	if fmt not in ("tar", "zip"):
+		print("-T: Must be tar or zip")
 		return 1
-	#Gather files
-	filelist = []
-	if os.path.exists(f"{indir}/filelist"):
-		print("Filelist mode")
-		#if filelist exists
-		j = 0
-		t = [0]
-		for i in open(f"{indir}/filelist"):
-			if len(t) == 1:
-				t.append(i.strip()) #get filename from first line
-			elif len(t) == 2:
-				# group# image# x y shared?
-				e = i.strip().split() #get additional information from second line
-				try:
-					t.append(int(e[0]))
-					t.append(int(e[1]))
-					t.append(int(e[2]))
-					t.append(int(e[3]))
-				except:
-					print(f"Fatal: {e} is not well formatted information.");
+	try:
+		sff = SffArchive(sys.argv[2])
+	except(IOError):
+		print("SFF open failed")
+		return 2
+	idx = sff.getindex(getoption("-I") != None)
+	if not sff.parse():
+		sff.close()
+		return 3
+	selected = sff_selectimages(sff, idx, selector)
+	entries = sff_exportentries(sff, selected, getoption("-f") != None, getoption("-p") != None)
+	mtime = int(os.fstat(sff.file.fileno()).st_mtime)
+	try:
+		with sff_phase("write"):
+			if outfile == "-":
+				sff_writearchive(sys.__stdout__.buffer, fmt, entries, mtime)
+				sys.__stdout__.buffer.flush()
+			else:
+				outfile = os.path.expanduser(outfile)
+				if os.path.exists(outfile):
+					print(f"Fatal: Output destination {outfile} already exists!")
+					sff.close()
 					return 1
-				if not sff_checkparam(t[2], t[3], t[4], t[5]):
-					print("Fatal: parameter not in range.")
+				f = open(outfile, "wb")
+				sff_count("files_opened")
+				sff_writearchive(f, fmt, entries, mtime)
+				f.close()
+	except(IOError):
+		print(f"Fatal: {outfile} write failed!")
+		sff.close()
+		return 2
+	entries = None
+	sff.close()
+	if outfile == "-":
+		outfile = "stdout"
+	print(f"Exported {len(selected)} images into {outfile}. Have a nice day.")
+	return 0
+
+#parse filelist lines, returns list of [0, filename, group, image, px, py, shared, linkid]
+#returns None if failed. if linkmode is True, files that share same filename are linked
+#to first one.
+def sff_parsefilelist(lines, linkmode):
+	filelist = []
+	firstname = {} #filename -> first index in filelist
+	t = [0]
+	for i in lines:
+		if len(t) == 1:
+			t.append(i.strip()) #get filename from first line
+		elif len(t) == 2:
+			# group# image# x y shared?
+			e = i.strip().split() #get additional information from second line
+			try:
+				t.append(int(e[0]))
+				t.append(int(e[1]))
+				t.append(int(e[2]))
+				t.append(int(e[3]))
+			except:
+				print(f"Fatal: {e} is not well formatted information.");
+				return None
+			if not sff_checkparam(t[2], t[3], t[4], t[5]):
+				print("Fatal: parameter not in range.")
+				return None
+			if len(e) > 4 and e[4] == "shared":
+				t.append(True)
+			else:
+				t.append(False)
+			#Find duplicated filename and link if -f option is present
+			if linkmode and t[1] in firstname:
+				t.append(firstname[t[1]])
+			else:
+				firstname.setdefault(t[1], len(filelist))
+				t.append(None)
+			filelist.append(t)
+			t = [0]
+	if len(t) == 2:
+		print("Fatal: Incomplete file list")
+		return None
+	return filelist
+
+#guess image information from pcx filenames (id_grp_img_x_y_shared.pcx) in names,
+#returns list like sff_parsefilelist (sorted by id), or None if failed.
+def sff_guessfilelist(names):
+	filelist = []
+	for i in names:
+		#decode filename
+		t = os.path.basename(i)[:-4] #get basename
+		t = t.split("_") #id, grp, img, x, y
+		try:
+			t[0] = int(t[0])
+			t[1] = int(t[1])
+			t[2] = int(t[2])
+			t[3] = int(t[3])
+			t[4] = int(t[4])
+		except:
+			print(f"Fatal: {i} does not have well formatted filename!")
+			return None
+		if not sff_checkparam(t[1], t[2], t[3], t[4]):
+			print(f"Fatal: {i}: parameter over flow!")
+			return None
+		#if filename has string "shared", set shared palette mode flag
+		shared = False
+		if len(t) > 5 and t[5] == "shared":
+			shared = True
+		#id, filename, group, image, px, py, shared
+		filelist.append((t[0], i, t[1], t[2], t[3], t[4], shared, None))
+	return sorted(filelist, key=lambda e: e[0]) #sort by id
+
+#Duplication check, multiple existance of images that shares same grp# and img# is forbidden.
+#existing is image information list of sff to append to, returns True if no duplication
+def sff_checkduplicate(filelist, existing):
+	used = set()
+	for i in range(len(filelist)):
+		t = (filelist[i][2], filelist[i][3])
+		if t in used:
+			print(f"Fatal: FileList: Already exists: Group{t[0]} Image{t[1]}")
+			return False
+		used.add(t)
+	for k in existing:
+		if (k.group, k.image) in used:
+			print(f"Fatal: AppendSFF: Already exists: Group{k.group} Image{k.image}")
+			return False
+	return True
+
+#SFF build manifest sidecar file (sfffile.build) of incremental create, JSON of
+#{"version": 1, "sffsize": sff size, "sffmtime": sff mtime (ns), "images": list of image}
+#image is null for linked image, otherwise {"path": filename in filelist, "size": pcx size,
+#"mtime": pcx mtime (ns), "hash": blake2b of pcx, "offset": image data offset in sff,
+#"length": image data length, "crop": [removed width, removed height] or null,
+#"autocrop": -c was used, "nopal": palette was removed}
+SFFBUILD_VERSION = 1
+
+#get build manifest file name of sffname
+def sff_buildpath(sffname):
+	return f"{sffname}.build"
+
+#load build manifest of sffname, returns dict of (path, nopal) -> image (see SFFBUILD_VERSION)
+#whose data is still in sffname. returns empty dict if manifest is missing or stale
+def sff_loadmanifest(sffname):
+	try:
+		f = open(sff_buildpath(sffname))
+		sff_count("files_opened")
+		m = json.load(f)
+		f.close()
+		st = os.stat(sffname)
+	except(IOError, ValueError):
+		return {}
+	if type(m) != dict or m.get("version") != SFFBUILD_VERSION or \
+		m.get("sffsize") != st.st_size or m.get("sffmtime") != st.st_mtime_ns:
+		return {}
+	r = {}
+	for e in m.get("images", []):
+		if e != None and e["offset"] + e["length"] <= st.st_size:
+			r[(e["path"], e["nopal"])] = e
+	return r
+
+#write build manifest of sffname, images is list of image (see SFFBUILD_VERSION)
+def sff_writemanifest(sffname, images):
+	st = os.stat(sffname)
+	m = {"version": SFFBUILD_VERSION, "sffsize": st.st_size, "sffmtime": st.st_mtime_ns,
+		"images": images}
+	writebin(sff_buildpath(sffname), json.dumps(m).encode())
+
+#incremental create (c -u), rebuild sfffile from filelist (see sff_parsefilelist) of images
+#in indir. image data of unchanged pcx files are taken from previous sfffile using build
+#manifest, returns return code. if changed (set of filenames in indir) is given, only those
+#files are checked and others are assumed to be same as manifest (watch mode).
+#if members (SffArchiveInput) is given, files are taken from it and compared by hash
+def sff_incrementalcreate(sfffile, indir, filelist, autocrop, removepal, changed = None,
+	members = None):
+	cache = sff_loadmanifest(sfffile)
+	old = None
+	if len(cache) != 0:
+		old = SffArchive(sfffile)
+		if not old.parse():
+			old.close()
+			old = None
+			cache = {}
+	if len(cache) == 0:
+		print("No valid build manifest, building all images.")
+	images = [] #(SubfileRecord, data)
+	manifest = []
+	cropped = {} #index in filelist -> (removed width, removed height) by autocrop
+	unchanged = set() #indexes in filelist copied from previous sff
+	for i in range(len(filelist)):
+		e = filelist[i]
+		px = e[4]
+		py = e[5]
+		filename = f"{indir}/{e[1]}"
+		if e[7] != None:
+			if e[7] in cropped:
+				#linked image shares cropped data, move axis too
+				px -= cropped[e[7]][0]
+				py -= cropped[e[7]][1]
+				if not sff_checkaxis(px, py):
+					print(f"Fatal: {filename}: axis over flow after autocrop!")
 					return 1
-				if len(e) > 4 and e[4] == "shared":
-					t.append(True)
+			images.append((SubfileRecord(0, 0, px, py, e[2], e[3], e[7], e[6]), b""))
+			manifest.append(None)
+			continue
+		nopal = removepal and e[6] and i != 0
+		c = cache.get((e[1], nopal))
+		if c != None and c["autocrop"] != autocrop:
+			c = None
+		data = None
+		try:
+			if members != None:
+				data = members.read(e[1])
+				if data == None:
+					raise IOError("not in archive")
+				#archive members do not have reliable mtime, always compare hash
+				size = len(data)
+				mtime = None
+				digest = hashlib.blake2b(data, digest_size = 16).hexdigest()
+			else:
+				if c != None and changed != None and e[1] not in changed and \
+					os.path.dirname(e[1]) == "":
+					size = c["size"]
+					mtime = c["mtime"]
 				else:
-					t.append(False)
-				#Find duplicated filename and link if -f option is present
-				if m_linkmode != None:
-					for j in range(len(filelist)):
-						if t[1] == filelist[j][1]:
-							t.append(j)
-							break
-				if len(t) < 8:
-					t.append(None)
-				filelist.append(t)
-				t = [0]
-		if len(t) == 2:
-			print("Fatal: Incomplete file list")
-			return 1
-	else:
-		print("Filename guess mode")
-		#iff there's no filelist, guess information from filename
-		for i in os.listdir(indir):
-			#process only for ".pcx" file
-			if not os.path.isfile(f"{indir}/{i}") or i[-4:] != ".pcx":
-				continue
-			#decode filename
-			t = i[:-4] #get basename
-			t = t.split("_") #id, grp, img, x, y
+					st = os.stat(filename)
+					size = st.st_size
+					mtime = st.st_mtime_ns
+				if c != None and c["size"] == size and c["mtime"] == mtime:
+					digest = c["hash"]
+				else:
+					with sff_phase("read"):
+						f = open(filename, "rb")
+						data = f.read()
+						f.close()
+					sff_count("files_opened")
+					sff_countread(len(data))
+					digest = hashlib.blake2b(data, digest_size = 16).hexdigest()
+		except(IOError):
+			print(f"Fatal: {filename} read failed!")
+			if old != None:
+				old.close()
+			return 3
+		crop = None
+		if c != None and c["hash"] == digest:
+			#same content as previous build, copy image data from previous sff
+			data = old.read(c["offset"], c["length"])
+			crop = c["crop"]
+			unchanged.add(i)
+		else:
+			if autocrop:
+				with sff_phase("autocrop"):
+					data, px, py, crop = sff_autocrop(data, px, py)
+			if nopal:
+				with sff_phase("palette"):
+					data = pcx_tryremovepal(data)
+		if crop != None:
+			crop = tuple(crop)
+			cropped[i] = crop
+			px = e[4] - crop[0]
+			py = e[5] - crop[1]
+		images.append((SubfileRecord(0, len(data), px, py, e[2], e[3], None, e[6]), data))
+		manifest.append({"path": e[1], "size": size, "mtime": mtime,
+			"hash": digest, "offset": 0, "length": len(data), "crop": crop,
+			"autocrop": autocrop, "nopal": nopal})
+	#image data offsets in new sff (same layout as sff_writeimages)
+	ptr = 0x200
+	for k in range(len(images)):
+		r = images[k][0]
+		r.offset = ptr + 0x20
+		if manifest[k] != None:
+			manifest[k]["offset"] = r.offset
+		ptr = sff_getoptimaloffset(ptr, r.size)
+	for k in range(len(images)):
+		r = images[k][0]
+		#watch mode shows only changed images
+		if changed != None and (k in unchanged or r.size == 0):
+			continue
+		print(f"{k}: {indir}/{filelist[k][1]}: Group{r.group} Image{r.image} {r.x}x{r.y}", end = "")
+		if r.shared:
+			print(" Shared", end = "")
+		if r.size == 0:
+			print(f" Linked to {r.link}", end = "")
+		elif k in unchanged:
+			print(" Unchanged", end = "")
+		print()
+	#nothing to write if all images are same as previous sff (including layout)
+	if old != None and len(unchanged) == len(images) - manifest.count(None) and \
+		[(r.offset, r.size, r.x, r.y, r.group, r.image, r.link, r.shared) for r, d in images] == \
+		[(r.offset, r.size, r.x, r.y, r.group, r.image, r.link, r.shared) for r in old]:
+		old.close()
+		print(f"{sfffile} is up to date. Have a nice day.")
+		return 0
+	try:
+		with sff_phase("write"):
+			sff_writeimages(sfffile, len(images), images)
+			sff_count("sprites", len(images))
+	except(IOError):
+		print(f"Fatal: {sfffile} write failed!")
+		return 2
+	finally:
+		if old != None:
+			old.close()
+	sff_writemanifest(sfffile, manifest)
+	print(f"Written {len(images)} images ({len(unchanged)} unchanged). Have a nice day.")
+	return 0
+
+#files of tar (may be compressed) or zip archive path ("-" for tar stream from stdin) for
+#create mode, without extracting them. zip members are read when they are needed. tar is read
+#in one sequential pass and only members that arrive before they are needed are kept in memory
+#(export mode writes filelist first and images in filelist order, so nothing is kept).
+#if filelist (or all files if there is no filelist) is in one directory, it is used as infiledir.
+#raises IOError if archive is not readable
+class SffArchiveInput:
+	def __init__(self, path):
+		self.path = path
+		self.zip = None
+		self.tar = None
+		self.names = {} #zip: filename -> ZipInfo
+		self.pending = {} #tar members already read: filename -> data
+		self.uses = None #filename -> remaining read count (None = keep all read members)
+		self.prefix = "" #directory used as infiledir
+		try:
+			if path != "-" and zipfile.is_zipfile(path):
+				self.zip = zipfile.ZipFile(path)
+				for info in self.zip.infolist():
+					if not info.is_dir():
+						self.names[self.normalize(info.filename)] = info
+			else:
+				if path == "-":
+					self.tar = tarfile.open(fileobj = sys.stdin.buffer, mode = "r|*")
+				else:
+					self.tar = tarfile.open(path, mode = "r|*")
+		except(EOFError, zlib.error, tarfile.TarError, zipfile.BadZipFile) as e:
+			raise IOError(f"{path} is not readable archive") from e
+		sff_count("files_opened")
+
+	#remove "./" from member name
+	@staticmethod
+	def normalize(name):
+		while name[:2] == "./":
+			name = name[2:]
+		return name
+
+	#returns "dir/" if all names are in one directory dir, otherwise ""
+	@staticmethod
+	def commondir(names):
+		tops = set(k.split("/", 1)[0] if "/" in k else None for k in names)
+		if len(tops) == 1 and None not in tops:
+			return tops.pop() + "/"
+		return ""
+
+	#returns True if name is filelist on top or in one directory of archive
+	@staticmethod
+	def isfilelist(name):
+		return name.split("/")[-1] == "filelist" and name.count("/") <= 1
+
+	#read next file in tar, returns (filename, data) or None if there are no more files
+	def nextmember(self):
+		try:
+			info = self.tar.next()
+			while info != None:
+				#tarfile keeps all member headers, they are not needed after reading
+				self.tar.members.clear()
+				if info.isfile():
+					data = self.tar.extractfile(info).read()
+					sff_countread(len(data))
+					return (self.normalize(info.name), data)
+				info = self.tar.next()
+		except(EOFError, zlib.error, tarfile.TarError) as e:
+			raise IOError(f"{self.path} is broken") from e
+		return None
+
+	#returns data of filelist, or None if there is no filelist (all tar members are read then)
+	def filelist(self):
+		if self.zip != None:
+			names = [k for k in self.names if self.isfilelist(k)]
+			if len(names) == 0:
+				self.prefix = self.commondir(self.names)
+				return None
+			self.prefix = min(names, key = len)[:-len("filelist")]
+			return self.read("filelist")
+		while True:
+			t = self.nextmember()
+			if t == None:
+				break
+			if self.isfilelist(t[0]):
+				self.prefix = t[0][:-len("filelist")]
+				return t[1]
+			self.pending[t[0]] = t[1]
+		self.prefix = self.commondir(self.pending)
+		return None
+
+	#returns pcx filenames in infiledir (filename guess mode)
+	def pcxnames(self):
+		n = len(self.prefix)
+		return [k[n:] for k in (self.names if self.zip != None else self.pending)
+			if k[:n] == self.prefix and k[-4:] == ".pcx" and "/" not in k[n:]]
+
+	#tell filenames to be read (same name may appear many times), tar members that are not
+	#in names are not kept in memory after this
+	def expect(self, names):
+		self.uses = collections.Counter(self.prefix + k for k in names)
+		self.pending = {k: v for k, v in self.pending.items() if k in self.uses}
+
+	#returns data of filename in infiledir, or None if there is no such file
+	def read(self, name):
+		k = self.prefix + name
+		if self.zip != None:
+			if k not in self.names:
+				return None
 			try:
-				t[0] = int(t[0])
-				t[1] = int(t[1])
-				t[2] = int(t[2])
-				t[3] = int(t[3])
-				t[4] = int(t[4])
-			except:
-				print(f"Fatal: {indir}/{i} does not have well formatted filename!")
-				return 1
-			if not sff_checkparam(t[1], t[2], t[3], t[4]):
-				print(f"Fatal: {indir}/{i}: parameter over flow!")
-				return 1
-			#if filename has string "shared", set shared palette mode flag
-			shared = False
-			if len(t) > 5 and t[5] == "shared":
-				shared = True
-			#id, filename, group, image, px, py, shared
-			filelist.append((t[0], i, t[1], t[2], t[3], t[4], shared, None))
-		filelist = sorted(filelist, key=lambda e: e[0]) #sort by id
+				data = self.zip.read(self.names[k])
+			except(EOFError, zlib.error, zipfile.BadZipFile) as e:
+				raise IOError(f"{self.path} is broken") from e
+			sff_countread(len(data))
+			return data
+		data = self.pending.get(k)
+		while data == None:
+			t = self.nextmember()
+			if t == None:
+				return None
+			if t[0] == k:
+				data = t[1]
+			elif self.uses == None or t[0] in self.uses:
+				self.pending[t[0]] = t[1]
+		if self.uses != None:
+			self.uses[k] -= 1
+			if self.uses[k] > 0:
+				self.pending[k] = data
+			else:
+				self.pending.pop(k, None)
+		return data
+
+	def close(self):
+		if self.zip != None:
+			self.zip.close()
+		if self.tar != None:
+			self.tar.close()
+		self.pending = {}
+
+#gather images in indir from filelist or pcx filenames, returns list like sff_parsefilelist
+#or None if failed. names is list of pcx filenames in indir (scan indir if None).
+#if members (SffArchiveInput) is given, files are taken from it instead of indir
+def sff_gatherfiles(indir, linkmode, names = None, members = None):
+	with sff_phase("filelist"):
+		if members != None:
+			try:
+				data = members.filelist()
+			except(IOError):
+				print(f"Fatal: {indir} read failed!")
+				return None
+			if data != None:
+				print("Filelist mode")
+				filelist = sff_parsefilelist(data.decode(errors = "replace").splitlines(), linkmode)
+			else:
+				print("Filename guess mode")
+				filelist = sff_guessfilelist(members.pcxnames())
+			if filelist != None:
+				members.expect([e[1] for e in filelist if e[7] == None])
+			return filelist
+		if os.path.exists(f"{indir}/filelist"):
+			print("Filelist mode")
+			#if filelist exists
+			try:
+				f = open(f"{indir}/filelist")
+			except(IOError):
+				print(f"Fatal: {indir}/filelist read failed!")
+				return None
+			sff_count("files_opened")
+			filelist = sff_parsefilelist(f, linkmode)
+			sff_countread(f.tell())
+			f.close()
+		else:
+			print("Filename guess mode")
+			#iff there's no filelist, guess information from filename
+			if names == None:
+				names = []
+				for i in os.scandir(indir):
+					#process only for ".pcx" file
+					if i.is_file() and i.name[-4:] == ".pcx":
+						names.append(i.name)
+			filelist = sff_guessfilelist(names)
+	return filelist
+
+#create mode body, write images in indir (or members, see SffArchiveInput) into sfffile,
+#m_* are options of create mode. returns return code
+def sff_createimages(sfffile, indir, members, m_autocrop, m_linkmode, m_removepal, m_index,
+	m_incremental):
+	filelist = sff_gatherfiles(indir, m_linkmode != None, members = members)
+	if filelist == None:
+		return 1
+	if m_incremental != None:
+		if not sff_checkduplicate(filelist, []):
+			return 1
+		r = sff_incrementalcreate(sfffile, indir, filelist, m_autocrop != None, m_removepal != None,
+			members = members)
+		if r == 0:
+			sff_updateindex(sfffile, m_index != None, True)
+		return r
 	ptr = 0x200 # next subfile header offset pointer
 	indexoffset = 0
-	#Duplication check, multiple existance of images that shares same grp# and img# is forbidden.
-	for i in range(len(filelist)):
-		grp = filelist[i][2]
-		img = filelist[i][3]
-		for j in range(len(filelist)):
-			#exit if not comparing same object + grp id are same + img id are same
-			if i != j and grp == filelist[j][2] and img == filelist[j][3]:
-				print(f"Fatal: FileList: Already exists: Group{grp} Image{img}")
-				return 1
+	lastsubheader = None #offset of final subheader of existing sff
+	l = []
 	#if sff already exists, open in append mode
 	if os.path.exists(sfffile):
 		#in append mode, change image count on header with existing image count + appending image
 		#count and change last next_ptr to appropriate one
-		sff = open(sfffile, "r+b") #open file for read/write mode (non-turncate)
 		#get last image pointer and image size
-		l = sff_getinfo(sff)
-		if l == None:
+		try:
+			arc = SffArchive(sfffile)
+		except(IOError):
+			print(f"Fatal: {sfffile} open failed!")
+			return 2
+		if not arc.parse():
+			arc.close()
 			return 3
+		arc.close() #image information columns are still usable
+		l = arc
 		if len(l) != 0:
-			lastfileptr = l[-1][0] #get final image pointer
-			# find optimal offset of next image
-			ptr = sff_getoptimaloffset(lastfileptr, l[-1][1])
-			#rewrite next subheader pointer of final image
-			sff.seek(lastfileptr - 0x20) #seek to final subfile header
-			sff.write(struct.pack("<L", ptr)) #overwrite next_ptr
-			#Duplication check with existing images
-			for i in range(len(filelist)):
-				grp = filelist[i][2]
-				img = filelist[i][3]
-				for k in l:
-					if grp == k[4] and img == k[5]:
-						print(f"Fatal: AppendSFF: Already exists: Group{grp} Image{img}")
-						sff.close()
-						return 1
+			lastsubheader = l.offsets[-1] - 0x20 #get final subfile header pointer
+			# find optimal offset of next image (after all images, chain order may differ
+			# from physical order after reorder)
+			ptr = sff_getendoffset(l.offsets, l.sizes)
 		indexoffset = len(l) #index offset for getting appropriate link num
-		#rewrite header - rewrite image count 
-		sff.seek(0x14)
-		sff.write(struct.pack("<L", len(l) + len(filelist)))
-		#rewrite header
-		sff.seek(0x30)
-		sff.write(b"Made by kumotech sprmaker clone for spr v1 (C) 2023 kumohakase")
+	#Duplication check (filelist itself and existing images)
+	if not sff_checkduplicate(filelist, l):
+		return 1
+	if indexoffset != 0:
+		sff = open(sfffile, "r+b") #open file for read/write mode (non-turncate)
+		sff.seek(ptr)
+		sff_count("seeks")
 	else:
-		#if sff doesn't exist, open file for writing and write header
+		#if sff doesn't exist, open file for writing and reserve header
 		sff = open(sfffile, "wb")
-		sff_writeheader(sff, len(filelist))
-	#write image files
+		sff.write(bytes(ptr))
+		sff_countwrite(ptr)
+	sff_count("files_opened")
+	cropped = {} #index in filelist -> (removed width, removed height) by autocrop
+	#write image files in one pass
 	for i in range(len(filelist)):
 		e = filelist[i]
 		filename = e[1]
@@ -651,70 +2160,300 @@ def create_mode():
 		linkid = e[7]
 		#read image file if not linked
 		if e[7] == None:
-			try:
-				f = open(filename, "rb")
-			except(IOError):
-				print(f"Fatal: {filename} read failed!")
-				sff.close()
-				return 3
-			data = f.read()
-			f.close()
+			if members != None:
+				#file in archive
+				with sff_phase("read"):
+					try:
+						data = members.read(e[1])
+					except(IOError):
+						print(f"Fatal: {indir} read failed!")
+						sff.close()
+						return 3
+				if data == None:
+					print(f"Fatal: {filename} not found in archive!")
+					sff.close()
+					return 3
+			else:
+				with sff_phase("read"):
+					try:
+						f = open(filename, "rb")
+					except(IOError):
+						print(f"Fatal: {filename} read failed!")
+						sff.close()
+						return 3
+					data = f.read()
+					f.close()
+				sff_count("files_opened")
+				sff_countread(len(data))
+			#remove empty area if -c (Autocrop) option is present
+			if m_autocrop != None:
+				with sff_phase("autocrop"):
+					data, px, py, crop = sff_autocrop(data, px, py)
+				if crop != None:
+					cropped[i] = crop
 			#if shared palette mode and -p (Remove palette) option is present, remove palette
 			#first image of sff can't be palette-omitted data
-			if m_removepal != None and e[6] and i != 0:
-				data = pcx_tryremovepal(data) #if data has palette, remove
+			if m_removepal != None and e[6] and i + indexoffset != 0:
+				with sff_phase("palette"):
+					data = pcx_tryremovepal(data) #if data has palette, remove
+		else:
+			linkid += indexoffset
+			if e[7] in cropped:
+				#linked image shares cropped data, move axis too
+				px -= cropped[e[7]][0]
+				py -= cropped[e[7]][1]
+				if not sff_checkaxis(px, py):
+					print(f"Fatal: {filename}: axis over flow after autocrop!")
+					sff.close()
+					return 1
 		filelen = len(data) #get filelength
 		nextptr = sff_getoptimaloffset(ptr, filelen) #calculate next subfile offset
 		#prepare header (nextptr, filelen, x, y, group#, image#, linkid, palette)
 		hdr = sff_generatesubheader(nextptr, filelen, px, py, g, im, linkid, e[6])
-		#write data to sff
-		sff.seek(ptr)
-		sff.write(hdr + data)
+		#write data to sff, pad previous image to 16 octets boundary
+		with sff_phase("write"):
+			pad = ptr - sff.tell()
+			if pad > 0:
+				sff.write(bytes(pad))
+				sff_countwrite(pad)
+			sff.write(hdr)
+			sff.write(data)
+		sff_countwrite(len(hdr))
+		sff_countwrite(len(data))
+		sff_count("sprites")
 		_i = i + indexoffset
 		print(f"{_i}: {filename}: Group{g} Image{im} {px}x{py}", end = "")
 		if e[6]:
 			print(" Shared", end = "")
 		if filelen == 0:
-			li = e[7] + indexoffset
-			print(f" Linked to {li}", end = "")
+			print(f" Linked to {linkid}", end = "")
 		print()
 		ptr = nextptr #update sff file pointer for next file
+	#all images are written, finally update header
+	if lastsubheader != None:
+		#rewrite next subheader pointer of final image
+		sff.seek(lastsubheader)
+		sff.write(struct.pack("<L", sff_getendoffset(l.offsets, l.sizes)))
+		sff_count("seeks")
+		sff_countwrite(4)
+	if indexoffset != 0:
+		#rewrite header - rewrite image count
+		sff.seek(0x14)
+		sff.write(struct.pack("<L", indexoffset + len(filelist)))
+		#rewrite header
+		sff.seek(0x30)
+		sff.write(b"Made by kumotech sprmaker clone for spr v1 (C) 2023 kumohakase")
+		sff_count("seeks", 2)
+		sff_countwrite(4)
+		sff_countwrite(63)
+	else:
+		sff_writeheader(sff, len(filelist))
 	sff.close()
+	sff_updateindex(sfffile, m_index != None)
 	img_ctr = len(filelist)
 	print(f"Written {img_ctr} images. Have a nice day.")
 	return 0
 
+def create_mode():
+	#if there is no sfffile option and infiledir show help and exit
+	if len(sys.argv) < 4:
+		print(HELPMSG_CREATE)
+		return 1
+	#check for parameters
+	m_autocrop = getoption("-c")
+	m_linkmode = getoption("-f")
+	m_removepal = getoption("-p")
+	m_index = getoption("-I")
+	m_incremental = getoption("-u")
+	indir = os.path.expanduser(sys.argv[3]) #input directory
+	sfffile = os.path.expanduser(sys.argv[2]) #target sff file
+	#directory existence check
+	if indir != "-" and not os.path.exists(indir):
+		print(f"Fatal: input directory {indir} not found!")
+		return 1
+	members = None #files in archive
+	if indir == "-" or os.path.isfile(indir):
+		try:
+			members = SffArchiveInput(indir)
+		except(IOError):
+			print(f"Fatal: {indir} is not readable tar or zip archive!")
+			return 1
+	try:
+		return sff_createimages(sfffile, indir, members, m_autocrop, m_linkmode, m_removepal,
+			m_index, m_incremental)
+	finally:
+		if members != None:
+			members.close()
+
+#inotify event masks (see linux/inotify.h)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+#seconds to wait for more changes after change (editors save file in several steps)
+SFF_WATCH_DEBOUNCE = 0.2
+#seconds between polls when inotify is not available
+SFF_WATCH_INTERVAL = 0.5
+
+#Watches changes of files in directory path, uses inotify if available, otherwise polls
+#stat of files in path
+class SffWatcher:
+	def __init__(self, path):
+		self.path = path
+		self.fd = None
+		self.snapshot = None
+		try:
+			libc = ctypes.CDLL(None, use_errno = True)
+			fd = libc.inotify_init1(os.O_CLOEXEC)
+			if fd >= 0:
+				mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+				if libc.inotify_add_watch(fd, os.fsencode(path), mask) >= 0:
+					self.fd = fd
+				else:
+					os.close(fd)
+		except(OSError, AttributeError):
+			pass
+		if self.fd == None:
+			self.snapshot = self.scan()
+
+	#returns dict of filename -> (size, mtime) of files in path
+	def scan(self):
+		r = {}
+		for e in os.scandir(self.path):
+			if e.is_file():
+				st = e.stat()
+				r[e.name] = (st.st_size, st.st_mtime_ns)
+		return r
+
+	#wait for changes up to timeout seconds (None = forever), returns set of changed
+	#filenames, or None if events were lost (all files have to be checked)
+	def read(self, timeout):
+		if self.fd == None:
+			time.sleep(SFF_WATCH_INTERVAL if timeout == None else timeout)
+			new = self.scan()
+			r = set(k for k in new.keys() | self.snapshot.keys() if new.get(k) != self.snapshot.get(k))
+			self.snapshot = new
+			return r
+		if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+			return set()
+		buf = os.read(self.fd, 65536)
+		r = set()
+		#struct inotify_event: int wd, uint32_t mask, cookie, len, char name[len]
+		ptr = 0
+		while ptr + 16 <= len(buf):
+			wd, mask, cookie, length = struct.unpack_from("iIII", buf, ptr)
+			if mask & IN_Q_OVERFLOW:
+				return None
+			r.add(os.fsdecode(buf[ptr + 16:ptr + 16 + length].rstrip(b"\0")))
+			ptr += 16 + length
+		return r
+
+	#wait until files are changed and no more changes come for SFF_WATCH_DEBOUNCE seconds,
+	#returns like read
+	def wait(self):
+		changed = set()
+		while changed != None and len(changed) == 0:
+			changed = self.read(None)
+		while True:
+			c = self.read(SFF_WATCH_DEBOUNCE)
+			if c == None or changed == None:
+				changed = None
+			elif len(c) == 0:
+				return changed
+			else:
+				changed |= c
+
+	def close(self):
+		if self.fd != None:
+			os.close(self.fd)
+
+def watch_mode():
+	if len(sys.argv) < 4:
+		print(HELPMSG_WATCH)
+		return 1
+	m_autocrop = getoption("-c") != None
+	m_linkmode = getoption("-f") != None
+	m_removepal = getoption("-p") != None
+	m_index = getoption("-I") != None
+	indir = os.path.expanduser(sys.argv[3])
+	sfffile = os.path.expanduser(sys.argv[2])
+	if not os.path.isdir(indir):
+		print(f"Fatal: input directory {indir} not found!")
+		return 1
+	watcher = SffWatcher(indir)
+	print(f"Watching {indir} ({'inotify' if watcher.fd != None else 'polling'}), press Ctrl+C to stop.")
+	#pcx filenames in indir (for filename guess mode), kept up to date by events
+	names = set(e.name for e in os.scandir(indir) if e.is_file() and e.name[-4:] == ".pcx")
+	pending = None #changed files since last successful build, None means all files
+	try:
+		while True:
+			filelist = sff_gatherfiles(indir, m_linkmode, sorted(names))
+			if filelist != None and sff_checkduplicate(filelist, []):
+				if sff_incrementalcreate(sfffile, indir, filelist, m_autocrop, m_removepal,
+					pending) == 0:
+					sff_updateindex(sfffile, m_index, True)
+					pending = set()
+			print("Waiting for changes...")
+			while True:
+				changed = watcher.wait()
+				if changed == None:
+					names = set(e.name for e in os.scandir(indir) if e.is_file() and \
+						e.name[-4:] == ".pcx")
+					pending = None
+					break
+				#ignore files that are not used (sfffile itself may be in indir)
+				changed = set(k for k in changed if k[-4:] == ".pcx" or k == "filelist")
+				for k in changed:
+					if k[-4:] == ".pcx":
+						if os.path.isfile(f"{indir}/{k}"):
+							names.add(k)
+						else:
+							names.discard(k)
+				if len(changed) != 0:
+					if pending != None:
+						pending |= changed
+					break
+	except(KeyboardInterrupt):
+		print("Stopped watching. Have a nice day.")
+	finally:
+		watcher.close()
+	return 0
+
 def delete_mode():
 	if len(sys.argv) < 3:
 		print(HELPMSG_DELETE)
 		return 1
 	selector = getselectionfilter() #get selector options
+	if selector == None:
+		return 1
 	m_noconfirm = getoption("-y")
+	m_compact = getoption("-C")
 	#stop dangerous operation
-	if selector[0] == None and selector[1] == None and selector[2] == None:
+	if selector.isall():
 		print("Stopped: Please specify selector (-i or -g or -n).")
 		return 1
 	infile = sys.argv[2]
-	removedcount = 0
 	try:
-		sff = open(infile, "rb")
+		sff = SffArchive(infile)
 	except(IOError):
 		print("Open failed")
 		return 2
-	#savedpal = None
-	#[image offset, size, x, y, group#, image#, link index, palette mode]
-	l = sff_getinfo(sff) #get all image information in sff
-	#fix image infomation according to selected deletion list
-	for i in range(len(l)):
+	idx = sff.getindex(getoption("-I") != None)
+	if not sff.parse():
+		sff.close()
+		return 3
+	l = sff.records() #get all image information in sff
+	deleted = set()
+	for i in sff_selectimages(sff, idx, selector):
 		e = l[i]
-		grp = e[4]
-		img = e[5]
-		#abort operation if not selected
-		if not decodeselectionfilter(selector, i, grp, img):
-			continue
+		grp = e.group
+		img = e.image
 		#avoid deleting index0
 		if i == 0:
 			print("Index0 image can not be removed!")
+			sff.close()
 			return 1
 		#Show deleteing file information
 		print(f"Deleting: {i}: Group{grp} Image{img}")
@@ -725,50 +2464,869 @@ def delete_mode():
 			if t != "y":
 				print(f"Undeleting: {i}: Group{grp} Image{img}")
 				continue
-		#fix link index number
-		for j in range(len(l)):
-			if l[j] == None:
-				continue
-			linkno = l[j][6]
-			#if linked index is bigger (and equal) than deleted image index, it will be decremented
-			if linkno != None and linkno >= i:
-				l[j][6] = linkno - 1#Store index=0 palette if deleting index 0 image.
-		#if program is going to delete index=0 image, program have to save palette
-		#data or sff will be broken
-		#if i == 0:
-		#	ioff = e[0] #image offset
-		#	isiz = e[1] #image size
-			#read image
-		#	sff.seek(ioff)
-		#	iimg = sff.read(isiz)
-		#	if not pcx_haspalette(iimg):
-		#		print("Insanity: SFF image 0 does not have palette. Aborting operation.")
-		#		return 1
-		#	savedpal = iimg[:-769] #save palette
-		l[i] = None #finally, set file information to None to notify the file is delete
-		removedcount = removedcount + 1
-	if removedcount == 0:
+		deleted.add(i)
+	if len(deleted) == 0:
 		print("SFF file is untouched.")
 		sff.close()
 		return 0
-	sff_reconstruct(infile, sff, l, savedpal) #reconstruct sff file by fixed information
-	print(f"Removed {removedcount} images.")
+	#remaining images can not be linked to deleted image
+	for i in range(len(l)):
+		if i not in deleted and l[i].link in deleted:
+			print(f"Fatal: {i} is linked to deleting image {l[i].link}, please delete it too.")
+			sff.close()
+			return 1
+	order = [i for i in range(len(l)) if i not in deleted] #remaining images
+	if m_compact != None:
+		#fix link index number and reconstruct sff file by fixed information
+		newindex = {order[k]: k for k in range(len(order))}
+		for i in order:
+			if l[i].link != None:
+				l[i].link = newindex[l[i].link]
+		sff_reconstruct(infile, sff, [l[i] if i in newindex else None for i in range(len(l))])
+		print(f"Removed {len(deleted)} images.")
+		return 0
+	#fast path: just unlink deleted images from subheader chain
+	filesize = len(sff.view)
+	sff.close()
+	with sff_phase("relink"):
+		sff_relink(infile, l, order)
+	sff_updateindex(infile, False, True)
+	dead = filesize - sff_getcompactsize([l[i].size for i in order])
+	print(f"Removed {len(deleted)} images. {dead} octets of dead space in sff.")
+	print("Run \"o sfffile -z\" to reclaim dead space.")
 	return 0
 
+#returns (image, link destination) of first linked image that refers same or later image
+#when images are ordered as order (list of current image indexes), or None if there is no
+#such image. links is list of link index of each image (None if actual image).
+#sff v1 link must refer previous image, mugen loads images in order.
+def sff_findforwardlink(links, order):
+	newindex = [0] * len(links)
+	for k in range(len(order)):
+		newindex[order[k]] = k
+	for k in range(len(order)):
+		li = links[order[k]]
+		if li != None and newindex[li] >= k:
+			return (order[k], li)
+	return None
+
+#relink subheader chain of sffname to order (list of current image indexes in new order),
+#records is image information (list of SubfileRecord or SffArchive) of sffname.
+#Images not in order are unlinked from chain (deleted), they must not be link destination
+#of remaining images.
+#Only image count, next pointers and link indexes in subheaders are rewritten
+#(through mmap), image data are not moved.
+def sff_relink(sffname, records, order):
+	newindex = [0] * len(records)
+	for k in range(len(order)):
+		newindex[order[k]] = k
+	endoffset = sff_getendoffset([e.offset for e in records], [e.size for e in records])
+	f = open(sffname, "r+b")
+	sff_count("files_opened")
+	m = mmap.mmap(f.fileno(), 0)
+	#image count and first subheader offset
+	struct.pack_into("<LL", m, 0x14, len(order), records[order[0]].offset - 0x20)
+	sff_countwrite(8)
+	for k in range(len(order)):
+		e = records[order[k]]
+		sub = e.offset - 0x20
+		if k + 1 < len(order):
+			nextptr = records[order[k + 1]].offset - 0x20
+		else:
+			nextptr = endoffset
+		struct.pack_into("<L", m, sub, nextptr)
+		sff_countwrite(4)
+		if e.link != None:
+			struct.pack_into("<H", m, sub + 0x10, newindex[e.link])
+			sff_countwrite(2)
+		sff_count("sprites")
+	m.flush()
+	m.close()
+	f.close()
+
 def reorder_mode():
-	if len(sys.argv) < 3:
+	if len(sys.argv) < 4:
 		print(HELPMSG_REORDER)
 		return 1
-	return 1
+	sfffile = sys.argv[2]
+	try:
+		sff = SffArchive(sfffile)
+	except(IOError):
+		print("SFF open failed")
+		return 2
+	if not sff.parse():
+		sff.close()
+		return 3
+	l = sff
+	#check index 0 image has palette while sff is open
+	haspal = [e.size != 0 and pcx_haspalette(sff.read(e.offset, e.size)) for e in l]
+	sff.close()
+	order = list(range(len(l)))
+	permfile = getoption("-P")
+	if permfile != None:
+		#read new order from permfile
+		try:
+			f = open(os.path.expanduser(permfile))
+			order = [int(i) for i in f.read().split()]
+			f.close()
+		except(IOError):
+			print(f"Fatal: {permfile} read failed!")
+			return 2
+		except(ValueError):
+			print(f"Fatal: {permfile} contains non number.")
+			return 1
+		if sorted(order) != list(range(len(l))):
+			print(f"Fatal: {permfile} must contain every index 0 - {len(l) - 1} once.")
+			return 1
+	else:
+		if len(sys.argv) < 5:
+			print(HELPMSG_REORDER)
+			return 1
+		try:
+			i1 = int(sys.argv[3])
+			i2 = int(sys.argv[4])
+		except(ValueError):
+			print("index1, index2: Must be number")
+			return 1
+		if not in_range(i1, 0, len(l) - 1) or not in_range(i2, 0, len(l) - 1):
+			print(f"index1, index2: Must be in range 0 - {len(l) - 1}")
+			return 1
+		order.insert(i2, order.pop(i1))
+	if order == list(range(len(l))):
+		print("SFF file is untouched.")
+		return 0
+	#index 0 image have to be actual image that has palette
+	if not haspal[order[0]]:
+		print(f"Fatal: {order[0]} can not be index0 image, it is linked or does not have palette.")
+		return 1
+	#linked image have to come after its link destination
+	t = sff_findforwardlink([e.link for e in l], order)
+	if t != None:
+		print(f"Fatal: {t[0]} is linked to {t[1]}, it can not be placed before {t[1]}.")
+		return 1
+	with sff_phase("relink"):
+		sff_relink(sfffile, l, order)
+	sff_updateindex(sfffile, False, True)
+	print(f"Reordered {len(l)} images. Have a nice day.")
+	return 0
 
 def optimization_mode():
 	if len(sys.argv) < 3:
 		print(HELPMSG_OPTIMIZE)
 		return 1
-	return 1
+	m_autocrop = getoption("-c")
+	m_linkmode = getoption("-f")
+	m_removepal = getoption("-p")
+	m_compact = getoption("-z")
+	if m_linkmode == None and m_autocrop == None and m_removepal == None and m_compact == None:
+		print("Stopped: Please specify optimization option.")
+		return 1
+	sfffile = sys.argv[2]
+	try:
+		sff = SffArchive(sfffile)
+	except(IOError):
+		print("SFF open failed")
+		return 2
+	if not sff.parse():
+		sff.close()
+		return 3
+	l = sff.records()
+	dead = len(sff.view) - sff_getcompactsize(sff.sizes)
+	if m_compact != None:
+		print(f"Found {dead} octets of dead space.")
+	linked = 0
+	if m_linkmode != None:
+		with sff_phase("dedup"):
+			linked = sff_linkduplicates(sff, l)
+		print(f"Found {linked} duplicated images.")
+	payloads = {} #index -> new image data
+	if m_autocrop != None:
+		with sff_phase("autocrop"):
+			payloads = sff_autocropall(sff, l)
+		print(f"Cropped {len(payloads)} images.")
+	shared = 0
+	if m_removepal != None:
+		with sff_phase("palette"):
+			shared = sff_sharepalettes(sff, l, payloads)
+		print(f"Removed palette from {shared} images.")
+	if linked == 0 and len(payloads) == 0 and dead <= 0:
+		print("SFF file is untouched.")
+		sff.close()
+		return 0
+	sff_reconstruct(sfffile, sff, l, payloads) #write optimized sff in one pass
+	print("SFF optimized. Have a nice day.")
+	return 0
 		
+#parse batch script text, returns list of operation dict or None if failed
+def sff_parsebatch(text):
+	if text.lstrip().startswith("["):
+		try:
+			ops = json.loads(text)
+		except(ValueError):
+			print("Fatal: Broken JSON script.")
+			return None
+		for op in ops:
+			if type(op) != dict or "op" not in op:
+				print(f"Fatal: {op}: Not an operation object.")
+				return None
+		return ops
+	ops = []
+	#argument names of text operations
+	argnames = {"renumber": ("index", "group", "image"), "reorder": ("from", "to"),
+		"axis": ("index", "x", "y"), "shared": ("index", "shared")}
+	for line in text.splitlines():
+		try:
+			t = shlex.split(line, comments = True)
+		except(ValueError):
+			print(f"Fatal: {line}: Broken quotation.")
+			return None
+		if len(t) == 0:
+			continue
+		op = {"op": t[0]}
+		if t[0] == "delete":
+			for k in ("i", "g", "n"):
+				v = getoption(f"-{k}", t)
+				if v != None:
+					op[k] = v
+		elif t[0] == "append":
+			if len(t) < 2:
+				print(f"Fatal: {line}: Missing infiledir.")
+				return None
+			op["dir"] = t[1]
+			op["f"] = "-f" in t
+			op["p"] = "-p" in t
+		elif t[0] in argnames:
+			if len(t) != len(argnames[t[0]]) + 1:
+				print(f"Fatal: {line}: Wrong argument count.")
+				return None
+			try:
+				for k, v in zip(argnames[t[0]], t[1:]):
+					op[k] = int(v)
+			except(ValueError):
+				print(f"Fatal: {line}: Arguments must be number.")
+				return None
+		ops.append(op)
+	return ops
+
+#apply batch operations ops to sff (parsed SffArchive).
+#returns (fixedinfo, payloads) for sff_reconstruct or None if failed.
+def sff_applybatch(sff, ops):
+	#working list element = [image offset, size, x, y, group#, image#, linked image element,
+	#palette mode, pcx filename to append (or None), remove palette]
+	#links refer to element itself, so indexes can change freely
+	w = [[e.offset, e.size, e.x, e.y, e.group, e.image, None, e.shared, None, False] for e in sff]
+	for i in range(len(w)):
+		li = sff[i].link
+		if li != None:
+			if li >= len(w):
+				print(f"Fatal: {i}: link id exceeds image count - 1")
+				return None
+			w[i][6] = w[li]
+	touched = [] #appended or renumbered elements
+	for n in range(len(ops)):
+		op = ops[n]
+		name = op["op"]
+		try:
+			for k in ("index", "from", "to"):
+				if k in op and (type(op[k]) != int or not in_range(op[k], 0, len(w) - 1)):
+					raise IndexError
+			if name == "delete":
+				args = []
+				for k in ("i", "g", "n"):
+					if k in op:
+						args += [f"-{k}", str(op[k])]
+				selector = getselectionfilter(args)
+				if selector == None:
+					return None
+				if len(args) == 0:
+					print(f"Fatal: Operation {n}: Please specify selector (i or g or n).")
+					return None
+				removed = set()
+				for i in range(len(w)):
+					if decodeselectionfilter(selector, i, w[i][4], w[i][5]):
+						removed.add(id(w[i]))
+				w = [e for e in w if id(e) not in removed]
+				for e in w:
+					if e[6] != None and id(e[6]) in removed:
+						print(f"Fatal: Operation {n}: deleting image that is linked from other image.")
+						return None
+			elif name == "append":
+				indir = os.path.expanduser(op["dir"])
+				if not os.path.isdir(indir):
+					print(f"Fatal: Operation {n}: input directory {indir} not found!")
+					return None
+				filelist = sff_gatherfiles(indir, op.get("f", False))
+				if filelist == None:
+					return None
+				added = []
+				for e in filelist:
+					t = [0, 0, e[4], e[5], e[2], e[3], None, e[6], None, False]
+					if e[7] != None:
+						t[6] = added[e[7]]
+					else:
+						t[8] = f"{indir}/{e[1]}"
+						if not os.path.isfile(t[8]):
+							print(f"Fatal: Operation {n}: {t[8]} not found!")
+							return None
+						t[9] = op.get("p", False) and e[6]
+					added.append(t)
+				w += added
+				touched += added
+			elif name == "renumber":
+				e = w[op["index"]]
+				if not sff_checkparam(op["group"], op["image"], e[2], e[3]):
+					print(f"Fatal: Operation {n}: parameter not in range.")
+					return None
+				e[4] = op["group"]
+				e[5] = op["image"]
+				touched.append(e)
+			elif name == "reorder":
+				w.insert(op["to"], w.pop(op["from"]))
+			elif name == "axis":
+				e = w[op["index"]]
+				if not sff_checkaxis(op["x"], op["y"]):
+					print(f"Fatal: Operation {n}: axis not in range.")
+					return None
+				e[2] = op["x"]
+				e[3] = op["y"]
+			elif name == "shared":
+				w[op["index"]][7] = bool(op["shared"])
+			else:
+				print(f"Fatal: Operation {n}: Unknown operation {name}")
+				return None
+		except(KeyError, TypeError):
+			print(f"Fatal: Operation {n}: Missing or wrong argument.")
+			return None
+		except(IndexError):
+			print(f"Fatal: Operation {n}: Index out of range.")
+			return None
+	if len(w) == 0:
+		print("Fatal: No images left.")
+		return None
+	#Duplication check of appended and renumbered images
+	used = collections.Counter((e[4], e[5]) for e in w)
+	for e in touched:
+		if used[(e[4], e[5])] > 1:
+			print(f"Fatal: Already exists: Group{e[4]} Image{e[5]}")
+			return None
+	#index 0 image have to be actual image
+	if w[0][6] != None:
+		print("Fatal: Index0 image must be actual image that has palette.")
+		return None
+	#index 0 image and actual images in individual palette mode have to have palette
+	for i in range(len(w)):
+		e = w[i]
+		if e[6] != None or (e[7] and i != 0):
+			continue
+		if e[8] == None:
+			haspal = pcx_haspalette(sff.read(e[0], e[1]))
+		else:
+			try:
+				haspal = pcx_haspalette(sff_readpcx(e[8], False))
+			except(IOError):
+				print(f"Fatal: {e[8]} read failed!")
+				return None
+		if not haspal:
+			if i == 0:
+				print("Fatal: Index0 image must be actual image that has palette.")
+			else:
+				print(f"Fatal: {i}: Non shared palette image, but there is no palette in PCX.")
+			return None
+	newindex = {id(w[i]): i for i in range(len(w))}
+	#linked image have to come after its link destination
+	t = sff_findforwardlink([None if e[6] == None else newindex[id(e[6])] for e in w],
+		range(len(w)))
+	if t != None:
+		print(f"Fatal: {t[0]} is linked to {t[1]}, it can not be placed before {t[1]}.")
+		return None
+	#build result
+	fixedinfo = []
+	payloads = {}
+	for i in range(len(w)):
+		e = w[i]
+		li = None
+		size = e[1]
+		if e[6] != None:
+			li = newindex[id(e[6])]
+			size = 0
+		elif e[8] != None:
+			#read appended file when it is written
+			#palette is removed only if image is still in shared palette mode
+			payloads[i] = lambda fname = e[8], rmpal = e[9] and e[7] and i != 0: \
+				sff_readpcx(fname, rmpal)
+		fixedinfo.append(SubfileRecord(e[0], size, e[2], e[3], e[4], e[5], li, e[7]))
+	return (fixedinfo, payloads)
+
+#read pcx file fname, and remove palette if removepal is True
+def sff_readpcx(fname, removepal):
+	f = open(fname, "rb")
+	data = f.read()
+	f.close()
+	if removepal:
+		data = pcx_tryremovepal(data)
+	return data
+
+def batch_mode():
+	if len(sys.argv) < 4:
+		print(HELPMSG_BATCH)
+		return 1
+	sfffile = sys.argv[2]
+	try:
+		f = open(os.path.expanduser(sys.argv[3]))
+		ops = sff_parsebatch(f.read())
+		f.close()
+	except(IOError):
+		print(f"Fatal: {sys.argv[3]} read failed!")
+		return 2
+	if ops == None:
+		return 1
+	try:
+		sff = SffArchive(sfffile)
+	except(IOError):
+		print("SFF open failed")
+		return 2
+	if not sff.parse():
+		sff.close()
+		return 3
+	with sff_phase("batch"):
+		r = sff_applybatch(sff, ops)
+	if r == None:
+		sff.close()
+		print("SFF file is untouched.")
+		return 1
+	try:
+		sff_reconstruct(sfffile, sff, r[0], r[1])
+	except(IOError):
+		print("Fatal: Image read or write failed, SFF file is untouched.")
+		sff.close()
+		return 3
+	print(f"Applied {len(ops)} operations, {len(r[0])} images. Have a nice day.")
+	return 0
+
 def main(args):
+	#messages go to stderr if data is written into stdout
+	if sff_datatostdout(args):
+		with contextlib.redirect_stdout(sys.stderr):
+			return runmain(args)
+	return runmain(args)
+
+def runmain(args):
 	print(CREDIT)
+	m_stats = getoption("--stats")
+	m_statsjson = getoption("--stats-json")
+	if m_stats != None or m_statsjson != None:
+		sff_enablestats()
+	r = runmode()
+	#show statistics of this run
+	if m_stats != None:
+		print(sff_stats.table())
+	if m_statsjson != None:
+		try:
+			f = open(os.path.expanduser(m_statsjson), "w")
+			json.dump(sff_stats.todict(), f, indent = 1)
+			f.close()
+		except(IOError):
+			print(f"Fatal: {m_statsjson} write failed!")
+			return max(r, 2)
+	return r
+
+#returns actual (not linked) image index of image i in sff (parsed SffArchive),
+#returns None if link is broken
+def sff_resolvelink(sff, i):
+	seen = set()
+	while sff.sizes[i] == 0:
+		seen.add(i)
+		i = sff.links[i]
+		if i >= len(sff) or i in seen:
+			return None
+	return i
+
+#convert images of selected (list of image indexes) in sff (parsed SffArchive) into
+#sff v2 file fname, raises ValueError if sff can not be converted
+def sff_tov2(sff, selected, fname):
+	newindex = {selected[k]: k for k in range(len(selected))}
+	sharedpal = None
+	if len(sff) != 0 and sff.sizes[0] != 0 and pcx_haspalette(sff.payload(0)):
+		sharedpal = bytes(sff.payload(0)[-768:])
+	#First pass: collect palettes (stored once) and image size from pcx header and trailer
+	palettes = []
+	palindex = {}
+	info = [] #(actual image index, width, height, palette index) of each selected image
+	for i in selected:
+		a = sff_resolvelink(sff, i)
+		if a == None:
+			raise ValueError(f"{i}: Broken link.")
+		data = sff.payload(a)
+		t = pcx_getinfo(data)
+		if t == None:
+			raise ValueError(f"{a}: Not a 256 indexed color pcx.")
+		pal = sharedpal
+		if (i == 0 or not sff.flags[i]) and pcx_haspalette(data):
+			pal = bytes(data[-768:])
+		if pal == None:
+			raise ValueError(f"{i}: Image does not have palette, and there is no shared palette.")
+		if pal not in palindex:
+			palindex[pal] = len(palettes)
+			palettes.append(pal)
+		info.append((a, t[0], t[1], palindex[pal]))
+	#Second pass: decode pcx and encode sprite data
+	def sprites():
+		for k in range(len(selected)):
+			i = selected[k]
+			a, w, h, pal = info[k]
+			e = SpriteNode(sff.groups[i], sff.images[i], w, h, sff.xs[i], sff.ys[i], None, 0, 8,
+				0, 0, pal)
+			sff_count("sprites")
+			#keep link if destination is converted too and uses same palette
+			if a != i and a in newindex and info[newindex[a]][3] == pal:
+				e.link = newindex[a]
+				yield (e, b"")
+				continue
+			t = pcx_decode(sff.payload(a))
+			if t == None:
+				raise ValueError(f"{a}: Broken pcx.")
+			e.fmt, data = sffv2_encode(t[2], w, h)
+			yield (e, data)
+	with sff_phase("write"), SffReplaceFile(fname) as f:
+		sffv2_write(f, palettes, len(selected), sprites())
+
+#convert sprites of selected (list of sprite indexes) in sff2 (parsed SffV2Archive) into
+#sff v1 file fname, raises ValueError if sff2 can not be converted
+def sff_tov1(sff2, selected, fname):
+	newindex = {selected[k]: k for k in range(len(selected))}
+	nodes = sff2.sprites
+	actual = []
+	for i in selected:
+		a = sff2.resolve(i)
+		if a == None:
+			raise ValueError(f"{i}: Broken link.")
+		actual.append(a)
+	#images that use palette of index0 image are stored in shared palette mode
+	sharedpal = None
+	if len(selected) != 0:
+		sharedpal = nodes[selected[0]].palette
+	def images():
+		for k in range(len(selected)):
+			i = selected[k]
+			a = actual[k]
+			e = nodes[i]
+			if e.palette >= len(sff2.palettes):
+				raise ValueError(f"{i}: Palette index exceeds palette count - 1")
+			shared = k != 0 and e.palette == sharedpal
+			r = SubfileRecord(0, 0, e.x, e.y, e.group, e.image, None, shared)
+			sff_count("sprites")
+			#keep link if destination is converted too and uses same palette
+			if k != 0 and a != i and a in newindex and nodes[a].palette == e.palette:
+				r.link = newindex[a]
+				yield (r, b"")
+				continue
+			pixels = sff2.pixels(a)
+			if pixels == None:
+				fmt = sff2.sprites[a].fmt
+				raise ValueError(f"{i}: Broken sprite or unsupported format {fmt}.")
+			pal = None
+			if not shared:
+				pal = sff2.palettes[e.palette]
+			yield (r, pcx_encode(nodes[a].width, nodes[a].height, pixels, pal))
+	with sff_phase("write"):
+		sff_writeimages(fname, len(selected), images())
+
+#write new sff v1 file fname, images is iterable of (SubfileRecord, data) for each image in
+#order (offset and size of SubfileRecord are ignored), count is image count.
+#images are streamed into temporary file in same directory, then it is renamed to fname.
+def sff_writeimages(fname, count, images):
+	with SffReplaceFile(fname) as f:
+		f.write(bytes(0x200))
+		ptr = 0x200
+		c = 0
+		for e, data in images:
+			c += 1
+			nextptr = sff_getoptimaloffset(ptr, len(data))
+			if c == count:
+				nextptr = 0
+			f.write(sff_generatesubheader(nextptr, len(data), e.x, e.y, e.group, e.image, e.link,
+				e.shared))
+			f.write(data)
+			#pad up to next subheader
+			pad = nextptr - ptr - 0x20 - len(data)
+			if pad > 0:
+				f.write(bytes(pad))
+			sff_countwrite(0x20 + len(data) + max(pad, 0))
+			ptr = nextptr
+		if c != count:
+			raise ValueError(f"image count mismatch ({c} != {count})")
+		sff_writeheader(f, c)
+
+def convert_mode():
+	if len(sys.argv) < 4:
+		print(HELPMSG_CONVERT)
+		return 1
+	selector = getselectionfilter()
+	if selector == None:
+		return 1
+	infile = sys.argv[2]
+	outfile = os.path.expanduser(sys.argv[3])
+	if os.path.exists(outfile):
+		print(f"Fatal: Output destination {outfile} already exists!")
+		return 1
+	try:
+		f = open(infile, "rb")
+		head = f.read(0x10)
+		f.close()
+		if len(head) == 0x10 and sffv2_isv2(head):
+			sff = SffV2Archive(infile)
+		else:
+			sff = SffArchive(infile)
+	except(IOError):
+		print("SFF open failed")
+		return 2
+	v2 = type(sff) == SffV2Archive
+	if v2:
+		if not sff.parse():
+			sff.close()
+			return 3
+		selected = []
+		for i in range(len(sff.sprites)):
+			if decodeselectionfilter(selector, i, sff.sprites[i].group, sff.sprites[i].image):
+				selected.append(i)
+	else:
+		idx = sff.getindex(getoption("-I") != None)
+		if not sff.parse():
+			sff.close()
+			return 3
+		selected = sff_selectimages(sff, idx, selector)
+	if len(selected) == 0:
+		print("Fatal: No images selected.")
+		sff.close()
+		return 1
+	try:
+		if v2:
+			sff_tov1(sff, selected, outfile)
+		else:
+			sff_tov2(sff, selected, outfile)
+	except(ValueError) as e:
+		print(f"Fatal: {e}")
+		sff.close()
+		return 3
+	sff.close()
+	print(f"Converted {len(selected)} images into sff v{1 if v2 else 2} {outfile}. Have a nice day.")
+	return 0
+
+#SFF patch file format
+#Header: "SFFPAT\0\x01", uint32_t base image count, 16 octets base hash (see sff_basehash),
+#uint32_t image count
+#Followed by zlib compressed entries, one for each image of patched sff in order:
+#int16_t x, int16_t y, uint16_t group#, uint16_t image#, uint16_t link index,
+#uint8_t palette mode, uint8_t kind, uint32_t value
+#kind 0 (SFFPATCH_COPY): copy image data of base image index value
+#kind 1 (SFFPATCH_DATA): value octets of image data follow
+#kind 2 (SFFPATCH_LINK): linked image (value is 0)
+SFFPATCH_MAGIC = b"SFFPAT\0\x01"
+SFFPATCH_HEADER = "<8sL16sL"
+SFFPATCH_ENTRY = "<hhHHHBBL"
+SFFPATCH_COPY = 0
+SFFPATCH_DATA = 1
+SFFPATCH_LINK = 2
+#octets of patch file read at once when patch is applied
+SFFPATCH_CHUNK = 0x10000
+
+#returns hash that identifies sff (parsed SffArchive) from digests (image data hashes
+#of all images, see sff_hashrecords) and image information
+def sff_basehash(sff, digests):
+	h = hashlib.blake2b(digest_size = 16)
+	for k in range(len(SFF_COLUMNS)):
+		h.update(getattr(sff, SFF_COLUMNS[k][0]).tobytes())
+	h.update(b"".join(digests))
+	return h.digest()
+
+#make patch that updates sff into newsff (both parsed SffArchive), returns
+#(patch, (unchanged, changed, added, removed) counts by (group, image))
+def sff_makepatch(sff, newsff):
+	with sff_phase("hash"):
+		olddigests = sff_hashrecords(sff, sff.records())
+		newdigests = sff_hashrecords(newsff, newsff.records())
+	source = {} #(digest, size) -> image index in sff
+	for i in range(len(sff)):
+		if sff.sizes[i] != 0:
+			source.setdefault((olddigests[i], sff.sizes[i]), i)
+	oldkeys = {}
+	for i in range(len(sff)):
+		oldkeys[(sff.groups[i], sff.images[i])] = i
+	entries = []
+	datalen = 0
+	unchanged = 0
+	changed = 0
+	added = 0
+	for i in range(len(newsff)):
+		e = newsff[i]
+		kind = SFFPATCH_LINK
+		value = 0
+		data = b""
+		if e.size != 0:
+			k = source.get((newdigests[i], e.size))
+			#make sure it is not hash collision
+			if k != None and sff.payload(k) == newsff.payload(i):
+				kind = SFFPATCH_COPY
+				value = k
+			else:
+				kind = SFFPATCH_DATA
+				data = newsff.payload(i)
+				value = len(data)
+				datalen += value
+		entries.append(struct.pack(SFFPATCH_ENTRY, e.x, e.y, e.group, e.image,
+			e.link if e.link != None else 0, e.shared, kind, value))
+		if len(data) != 0:
+			entries.append(data)
+		#count by (group, image)
+		k = oldkeys.pop((e.group, e.image), None)
+		if k == None:
+			added += 1
+		elif kind == SFFPATCH_COPY and k == value and (e.x, e.y, e.shared) == \
+			(sff.xs[k], sff.ys[k], sff.flags[k] != 0):
+			unchanged += 1
+		elif kind == SFFPATCH_LINK and sff.sizes[k] == 0 and (e.link, e.x, e.y, e.shared) == \
+			(sff.links[k], sff.xs[k], sff.ys[k], sff.flags[k] != 0):
+			unchanged += 1
+		else:
+			changed += 1
+	with sff_phase("compress"):
+		c = zlib.compressobj(9)
+		body = [c.compress(d) for d in entries]
+		body.append(c.flush())
+	hdr = struct.pack(SFFPATCH_HEADER, SFFPATCH_MAGIC, len(sff), sff_basehash(sff, olddigests),
+		len(newsff))
+	return ([hdr] + body, (unchanged, changed, added, len(oldkeys)))
+
+#apply patch (binary file object) to sff (parsed SffArchive) and write patched sff into
+#fname, raises ValueError if patch is broken or not made from sff.
+#patch is read and decompressed while images are written, only one entry is kept in memory
+def sff_applypatch(sff, patch, fname):
+	n = struct.calcsize(SFFPATCH_HEADER)
+	hdr = patch.read(n)
+	sff_countread(len(hdr))
+	if len(hdr) < n:
+		raise ValueError("Broken patch.")
+	magic, basecount, basehash, count = struct.unpack(SFFPATCH_HEADER, hdr)
+	if magic != SFFPATCH_MAGIC:
+		raise ValueError("Not a sff patch.")
+	if basecount != len(sff):
+		raise ValueError("Patch is not made from this sff (image count mismatch).")
+	with sff_phase("hash"):
+		if sff_basehash(sff, sff_hashrecords(sff, sff.records())) != basehash:
+			raise ValueError("Patch is not made from this sff (content mismatch).")
+	z = zlib.decompressobj()
+	buf = bytearray() #decompressed but not used octets
+	#returns next size octets of decompressed body
+	def take(size):
+		try:
+			while len(buf) < size and not z.eof:
+				data = z.unconsumed_tail
+				if len(data) == 0:
+					data = patch.read(SFFPATCH_CHUNK)
+					if len(data) == 0:
+						break
+					sff_countread(len(data))
+				buf.extend(z.decompress(data, max(size - len(buf), SFFPATCH_CHUNK)))
+		except(zlib.error):
+			raise ValueError("Broken patch.")
+		if len(buf) < size:
+			raise ValueError("Broken patch (truncated).")
+		r = bytes(buf[:size])
+		del buf[:size]
+		return r
+	#stream images from sff and patch body into new sff
+	def images():
+		for i in range(count):
+			x, y, grp, img, li, pal, kind, value = struct.unpack(SFFPATCH_ENTRY,
+				take(struct.calcsize(SFFPATCH_ENTRY)))
+			r = SubfileRecord(0, 0, x, y, grp, img, None, pal != 0)
+			sff_count("sprites")
+			if kind == SFFPATCH_COPY:
+				if value >= len(sff):
+					raise ValueError(f"{i}: Broken patch (source index out of range).")
+				yield (r, sff.payload(value))
+			elif kind == SFFPATCH_DATA:
+				yield (r, take(value))
+			else:
+				r.link = li
+				yield (r, b"")
+	with sff_phase("write"):
+		sff_writeimages(fname, count, images())
+
+def diff_mode():
+	if len(sys.argv) < 5:
+		print(HELPMSG_DIFF)
+		return 1
+	patchfile = os.path.expanduser(sys.argv[4])
+	arcs = []
+	for name in sys.argv[2:4]:
+		try:
+			arcs.append(SffArchive(os.path.expanduser(name)))
+		except(IOError):
+			print(f"Fatal: {name} open failed!")
+			for a in arcs:
+				a.close()
+			return 2
+		if not arcs[-1].parse():
+			for a in arcs:
+				a.close()
+			return 3
+	patch, counts = sff_makepatch(arcs[0], arcs[1])
+	try:
+		writebin(patchfile, *patch)
+	except(IOError):
+		print(f"Fatal: {patchfile} write failed!")
+		return 2
+	finally:
+		for a in arcs:
+			a.close()
+	size = sum(len(d) for d in patch)
+	print(f"{counts[0]} unchanged, {counts[1]} changed, {counts[2]} added, {counts[3]} removed.")
+	print(f"Written patch {patchfile} ({size} octets). Have a nice day.")
+	return 0
+
+def patch_mode():
+	if len(sys.argv) < 4:
+		print(HELPMSG_PATCH)
+		return 1
+	sfffile = os.path.expanduser(sys.argv[2])
+	patchfile = os.path.expanduser(sys.argv[3])
+	outfile = sfffile
+	if len(sys.argv) > 4:
+		outfile = os.path.expanduser(sys.argv[4])
+	try:
+		patch = open(patchfile, "rb")
+		sff_count("files_opened")
+	except(IOError):
+		print("Fatal: sff or patch open failed!")
+		return 2
+	try:
+		sff = SffArchive(sfffile)
+	except(IOError):
+		patch.close()
+		print("Fatal: sff or patch open failed!")
+		return 2
+	if not sff.parse():
+		sff.close()
+		patch.close()
+		return 3
+	try:
+		sff_applypatch(sff, patch, outfile)
+	except(ValueError) as e:
+		print(f"Fatal: {e}")
+		return 3
+	except(IOError):
+		print(f"Fatal: {outfile} write failed!")
+		return 2
+	finally:
+		sff.close()
+		patch.close()
+	sff_updateindex(outfile, False, True)
+	print(f"Patched {outfile}. Have a nice day.")
+	return 0
+
+#run function specified by mode, returns return code
+def runmode():
 	#if no mode specified then show help and quit
 	if len(sys.argv) < 2:
 		print(HELPMSG)
@@ -783,10 +3341,24 @@ def main(args):
 		return list_mode()
 	elif m == "x":
 		return extract_mode()
+	elif m == "e":
+		return export_mode()
 	elif m == "r":
 		return reorder_mode()
 	elif m == "o":
 		return optimization_mode()
+	elif m == "b":
+		return batch_mode()
+	elif m == "s":
+		return convert_mode()
+	elif m == "w":
+		return watch_mode()
+	elif m == "m":
+		return diff_mode()
+	elif m == "p":
+		return patch_mode()
+	elif m == "v":
+		return verify_mode()
 	else:
 		print(HELPMSG)
 		return 1
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for mugen toolchain
+(C) 2023 Kumohakase
+CC BY-SA 4.0 https://creativecommons.org/licenses/by-sa/4.0/
+Please consider supporting me through ko-fi.com
+https://ko-fi.com/kumohakase
+
+Generates deterministic synthetic SFF v1 files (and pcx + filelist directories)
+at several scales, then times sff.py (t, x, c fresh, c append, d) and sff_extractor.py
+on them. Every command is run as child process, wall time, peak RSS and octets
+read / written (from /proc/self/io of child, Linux only) are recorded.
+Octets read / written are counted by read() / write() family of syscalls,
+access through mmap is not counted. Octets read from / written to storage
+(read_bytes / write_bytes of /proc/self/io) and page faults include mmap access.
+All of them are counted only while benchmarked program runs (python startup and
+module imports are excluded).
+
+Usage: python sff_bench.py [options]
+-s scales: comma separated image counts (default 1000,10000,100000)
+-o outfile: result JSON file (default bench_output.json)
+-w workdir: directory for generated files (default temporary directory, removed after run)
+-r repeat: run each benchmark repeat times and keep fastest run (default 1)
+-S ratio: ratio of shared palette images (default 0.9)
+-L ratio: ratio of linked images (default 0.1)
+-Z size: maximum width and height of images (default 96)
+-R seed: random seed (default 1)
+-C oldfile: compare result with oldfile (result JSON of previous run)
+
+Same seed and options always generate same files, so results of different
+revisions can be compared.
+"""
+import sys, os, time, json, random, shutil, subprocess, tempfile, platform, resource
+from sff import getoption, sff_writeheader, sff_generatesubheader, sff_getoptimaloffset
+from pcx import pcx_encode
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+#count of distinct images, sprites are made from them
+BENCH_POOLSIZE = 256
+#images per group
+BENCH_GROUPLEN = 50
+
+#make pixels of width x height image with some opaque blobs on transparent background,
+#so RLE and autocrop behave like real sprites
+def bench_makepixels(rng, width, height):
+	rows = []
+	cx = rng.randrange(width)
+	for y in range(height):
+		row = bytearray(width)
+		#horizontal runs around wandering center
+		cx = min(max(cx + rng.randint(-2, 2), 0), width - 1)
+		l = rng.randint(0, cx)
+		r = rng.randint(cx, width - 1)
+		x = l
+		while x <= r:
+			n = rng.randint(1, 8)
+			c = rng.randrange(1, 256)
+			row[x:min(x + n, r + 1)] = bytes((c, )) * (min(x + n, r + 1) - x)
+			x += n
+		rows.append(bytes(row))
+	return b"".join(rows)
+
+#make list of poolsize distinct pcx images (with palette) of up to maxsize x maxsize
+def bench_makepool(rng, poolsize, maxsize):
+	pool = []
+	for i in range(poolsize):
+		w = rng.randint(8, maxsize)
+		h = rng.randint(8, maxsize)
+		palette = rng.randbytes(768)
+		pool.append(pcx_encode(w, h, bench_makepixels(rng, w, h), palette))
+	return pool
+
+#make list of count sprites [pool index, group#, image#, x, y, shared, link index or None]
+#group# starts at groupbase
+def bench_makesprites(rng, count, pool, shared, link, groupbase = 0):
+	r = []
+	for i in range(count):
+		g = groupbase + i // BENCH_GROUPLEN
+		im = i % BENCH_GROUPLEN
+		x = rng.randint(-64, 64)
+		y = rng.randint(-128, 0)
+		#index0 image have to be actual image that has palette
+		e = [rng.randrange(len(pool)), g, im, x, y, i != 0 and rng.random() < shared, None]
+		#link only inside group, so deleting whole groups never breaks links
+		if im != 0 and rng.random() < link:
+			li = rng.randrange(i - im, i)
+			#link destination have to be actual image, palette mode follows it
+			if r[li][6] != None:
+				li = r[li][6]
+			e[5] = r[li][5]
+			e[6] = li
+		r.append(e)
+	return r
+
+#write sprites into sff v1 file path, shared images are stored without palette
+def bench_writesff(path, pool, sprites):
+	sff = open(path, "wb")
+	sff.write(bytes(0x200))
+	ptr = 0x200
+	for i in range(len(sprites)):
+		p, g, im, x, y, shared, li = sprites[i]
+		data = b""
+		if li == None:
+			data = pool[p]
+			if shared:
+				data = data[:-769]
+		nextptr = sff_getoptimaloffset(ptr, len(data))
+		if i == len(sprites) - 1:
+			nextptr = 0
+		sff.write(sff_generatesubheader(nextptr, len(data), x, y, g, im, li, shared))
+		sff.write(data)
+		#pad up to next subheader
+		sff.write(bytes(max(nextptr - ptr - 0x20 - len(data), 0)))
+		ptr = nextptr
+	sff_writeheader(sff, len(sprites))
+	sff.close()
+
+#write pool images and filelist of sprites into directory path (input of sff.py c)
+#linked sprites are written as same filename as destination (linked by -f)
+def bench_writedir(path, pool, sprites):
+	os.mkdir(path)
+	for i in range(len(pool)):
+		f = open(f"{path}/{i}.pcx", "wb")
+		f.write(pool[i])
+		f.close()
+	lines = []
+	for p, g, im, x, y, shared, li in sprites:
+		if li != None:
+			p = sprites[li][0]
+		lines.append(f"{p}.pcx")
+		lines.append(f"{g} {im} {x} {y}" + (" shared" if shared else ""))
+	f = open(f"{path}/filelist", "w")
+	f.write("\n".join(lines) + "\n")
+	f.close()
+
+#returns I/O counters of this process, dict of /proc/self/io fields and page faults
+#(minflt, majflt). /proc/self/io fields are missing if it is not available
+def bench_readio():
+	io = {}
+	try:
+		f = open("/proc/self/io")
+		for line in f:
+			k, v = line.split(":")
+			io[k] = int(v)
+		f.close()
+	except(IOError):
+		pass
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	io["minflt"] = usage.ru_minflt
+	io["majflt"] = usage.ru_majflt
+	return io
+
+#run python script with args in this process (child side of bench_run), then write
+#I/O counters of script run into resultfile
+def bench_child(resultfile, script, args):
+	sys.argv = [script] + args
+	sys.path[0] = os.path.dirname(os.path.abspath(script))
+	rc = 0
+	#discard outputs of benchmarked program
+	sys.stdout = open(os.devnull, "w")
+	#compile script before counting, count only I/O of script run (not python startup,
+	#reading script and imports of this process)
+	f = open(script, "rb")
+	code = compile(f.read(), script, "exec")
+	f.close()
+	before = bench_readio()
+	try:
+		exec(code, {"__name__": "__main__", "__file__": script, "__builtins__": __builtins__})
+	except(SystemExit) as e:
+		rc = e.code if type(e.code) == int else 0
+	after = bench_readio()
+	r = {"returncode": rc}
+	for name, k in (("read", "rchar"), ("written", "wchar"), ("read_bytes", "read_bytes"),
+		("write_bytes", "write_bytes"), ("minflt", "minflt"), ("majflt", "majflt")):
+		r[name] = after[k] - before[k] if k in after and k in before else None
+	f = open(resultfile, "w")
+	json.dump(r, f)
+	f.close()
+	return rc
+
+#run python script with args as child process in directory cwd,
+#returns dict of wall time, peak RSS (KiB), I/O counters (see bench_child) and return code
+def bench_run(script, args, cwd):
+	fd, resultfile = tempfile.mkstemp(suffix = ".json")
+	os.close(fd)
+	cmd = [sys.executable, os.path.abspath(__file__), "--child", resultfile, script] + args
+	t = time.perf_counter()
+	p = subprocess.Popen(cmd, cwd = cwd)
+	pid, status, usage = os.wait4(p.pid, 0)
+	wall = time.perf_counter() - t
+	p.returncode = os.waitstatus_to_exitcode(status)
+	r = {"wall": wall, "maxrss_kib": usage.ru_maxrss, "read": None, "written": None,
+		"read_bytes": None, "write_bytes": None, "minflt": None, "majflt": None,
+		"returncode": p.returncode}
+	try:
+		f = open(resultfile)
+		r.update(json.load(f))
+		f.close()
+	except(IOError, ValueError):
+		pass
+	os.remove(resultfile)
+	return r
+
+#run benchmark name repeat times, prepare is called (in workdir) before each run
+#and returns args of script. returns result of fastest run
+def bench_measure(name, scale, script, prepare, workdir, repeat):
+	best = None
+	for n in range(repeat):
+		args = prepare()
+		r = bench_run(script, args, workdir)
+		if r["returncode"] != 0:
+			print(f"Warning: {name} ({scale}): returned {r['returncode']}")
+		if best == None or r["wall"] < best["wall"]:
+			best = r
+	best["name"] = name
+	best["scale"] = scale
+	print(f"{name:12} {scale:8} {best['wall']:9.3f}s {best['maxrss_kib']:9}KiB", end = "")
+	if best["read"] != None:
+		print(f" R={best['read']} W={best['written']}", end = "")
+	if best["read_bytes"] != None:
+		print(f" RB={best['read_bytes']} WB={best['write_bytes']}", end = "")
+	if best["minflt"] != None:
+		print(f" F={best['minflt']}+{best['majflt']}", end = "")
+	print()
+	return best
+
+#remove file or directory path if it exists
+def bench_remove(path):
+	if os.path.isdir(path):
+		shutil.rmtree(path)
+	elif os.path.exists(path):
+		os.remove(path)
+
+#generate files of scale and run all benchmarks in workdir, returns list of results
+def bench_scale(scale, workdir, repeat, rng, shared, link, maxsize):
+	sffscript = f"{BENCHDIR}/sff.py"
+	exscript = f"{BENCHDIR}/sff_extractor.py"
+	print(f"Generating {scale} images...")
+	pool = bench_makepool(rng, min(scale, BENCH_POOLSIZE), maxsize)
+	sprites = bench_makesprites(rng, scale, pool, shared, link)
+	#appending images are 1/10 of scale, group# follows existing images
+	appends = bench_makesprites(rng, max(scale // 10, 1), pool, shared, link,
+		scale // BENCH_GROUPLEN + 1)
+	base = f"{workdir}/{scale}.sff"
+	bench_writesff(base, pool, sprites)
+	bench_writedir(f"{workdir}/{scale}_in", pool, sprites)
+	bench_writedir(f"{workdir}/{scale}_add", pool, appends)
+	work = f"{workdir}/work.sff"
+	outdir = f"{workdir}/out"
+	#fresh copy of base sff as work sff
+	def copybase():
+		bench_remove(work)
+		bench_remove(f"{work}.idx")
+		shutil.copyfile(base, work)
+	def list_prepare():
+		return ["t", base]
+	def extract_prepare():
+		bench_remove(outdir)
+		return ["x", base, outdir]
+	def create_prepare():
+		bench_remove(work)
+		return ["c", work, f"{workdir}/{scale}_in", "-f"]
+	def append_prepare():
+		copybase()
+		return ["c", work, f"{workdir}/{scale}_add", "-f"]
+	def delete_prepare():
+		copybase()
+		#delete about 1/10 of images
+		groups = max(scale // BENCH_GROUPLEN // 10, 1)
+		return ["d", work, "-g", f"1:{groups}", "-y"]
+	def extractor_prepare():
+		bench_remove(outdir)
+		return [base, outdir]
+	r = []
+	r.append(bench_measure("list", scale, sffscript, list_prepare, workdir, repeat))
+	r.append(bench_measure("extract", scale, sffscript, extract_prepare, workdir, repeat))
+	r.append(bench_measure("create", scale, sffscript, create_prepare, workdir, repeat))
+	r.append(bench_measure("append", scale, sffscript, append_prepare, workdir, repeat))
+	r.append(bench_measure("delete", scale, sffscript, delete_prepare, workdir, repeat))
+	r.append(bench_measure("extractor", scale, exscript, extractor_prepare, workdir, repeat))
+	bench_remove(outdir)
+	bench_remove(work)
+	return r
+
+#print wall time ratio of results and old results (loaded from oldfile)
+def bench_compare(results, oldfile):
+	try:
+		f = open(oldfile)
+		old = json.load(f)["results"]
+		f.close()
+	except(IOError, ValueError, KeyError):
+		print(f"Fatal: {oldfile} read failed!")
+		return False
+	oldwall = {(e["name"], e["scale"]): e["wall"] for e in old}
+	print(f"Compared with {oldfile} (new / old wall time):")
+	for e in results:
+		k = (e["name"], e["scale"])
+		if k not in oldwall:
+			continue
+		print(f"{e['name']:12} {e['scale']:8} {e['wall'] / oldwall[k]:7.2f}x")
+	return True
+
+#convert option opt to type t, or default if it is not specified.
+#returns None if it is not convertable or not larger than minval
+def bench_getnumber(opt, t, default, minval):
+	v = getoption(opt)
+	if v == None:
+		return default
+	try:
+		v = t(v)
+	except(ValueError):
+		print(f"{opt}: Must be number")
+		return None
+	if v < minval:
+		print(f"{opt}: Must be number not smaller than {minval}")
+		return None
+	return v
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == "--child":
+		return bench_child(sys.argv[2], sys.argv[3], sys.argv[4:])
+	if getoption("-h") != None or getoption("?") != None:
+		print(__doc__)
+		return 0
+	try:
+		scales = [int(i) for i in (getoption("-s") or "1000,10000,100000").split(",")]
+	except(ValueError):
+		print("-s: Must be comma separated numbers")
+		return 1
+	if min(scales) < 1 or max(scales) > 0xffff * BENCH_GROUPLEN // 2:
+		print("-s: Scale not in range.")
+		return 1
+	repeat = bench_getnumber("-r", int, 1, 1)
+	shared = bench_getnumber("-S", float, 0.9, 0)
+	link = bench_getnumber("-L", float, 0.1, 0)
+	maxsize = bench_getnumber("-Z", int, 96, 8)
+	seed = bench_getnumber("-R", int, 1, 0)
+	if None in (repeat, shared, link, maxsize, seed):
+		return 1
+	outfile = getoption("-o") or "bench_output.json"
+	workdir = getoption("-w")
+	tmpdir = None
+	if workdir == None:
+		workdir = tmpdir = tempfile.mkdtemp(prefix = "sffbench")
+	elif not os.path.isdir(workdir):
+		print(f"Fatal: {workdir} is not a directory!")
+		return 1
+	workdir = os.path.abspath(workdir)
+	results = []
+	try:
+		for scale in scales:
+			#every scale is generated from its own seed, result does not depend on -s
+			rng = random.Random(f"{seed}:{scale}")
+			results += bench_scale(scale, workdir, repeat, rng, shared, link, maxsize)
+	finally:
+		if tmpdir != None:
+			shutil.rmtree(tmpdir)
+	info = {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+		"platform": platform.platform(), "seed": seed, "shared": shared, "link": link,
+		"maxsize": maxsize, "repeat": repeat}
+	f = open(outfile, "w")
+	json.dump({"info": info, "results": results}, f, indent = 1)
+	f.close()
+	print(f"Results are written to {outfile}")
+	oldfile = getoption("-C")
+	if oldfile != None and not bench_compare(results, oldfile):
+		return 2
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
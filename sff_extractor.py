@@ -39,6 +39,7 @@ Image format: pcx 256 indexed color (index=0 will treated as transparent)
 
 """
 import sys, os, struct
+from pcx import pcx_haspalette
 
 def main():
 	#Check for params, if not enough show help and exit
@@ -102,7 +103,7 @@ def main():
 			f = open(f"{outdir}/{i}.pcx", "wb")
 			f.write(data)
 			#add recorded palette if palette data was omitted
-			if data[1] == 5 and data[-769] != 12:
+			if data[1] == 5 and not pcx_haspalette(data):
 				f.write(pal)
 			else:
 				#if shared flag = 1 but data have palette data, i think it is wrong palette
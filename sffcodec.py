@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+"""
+SFF v2 sprite codecs (RLE8, RLE5, LZ5) for mugen toolchain
+(C) 2023 Kumohakase
+CC BY-SA 4.0 https://creativecommons.org/licenses/by-sa/4.0/
+Please consider supporting me through ko-fi.com
+https://ko-fi.com/kumohakase
+
+Used by sffv2.py. Pixels are handled as bytes of width * height octets
+(row major, 1 octet per pixel), same as pcx.py.
+Compressed data here does not include uint32_t uncompressed length that is stored
+in front of it in sff v2.
+Decoders expand runs by re module or table lookup (C) instead of per pixel python loop.
+RLE5 and LZ5 can store only color 0 - 31 (5 bit sprite), their encoders return None
+if pixels have other colors.
+
+RLE8:
+octet 0x40 - 0x7f means repeat next octet (octet & 0x3f) times,
+otherwise octet is pixel itself.
+
+RLE5: repeat of packets
+uint8_t, run length - 1 of first color
+uint8_t, bit 7: first color follows (otherwise color is 0), bit 0 - 6: count of 5 bit packets
+uint8_t, first color (only if bit 7 above is set)
+5 bit packets, bit 5 - 7: run length - 1, bit 0 - 4: color
+
+LZ5: control octet followed by 8 packets, bit n of control octet is type of packet n
+(0 = RLE, 1 = LZ)
+RLE packet:
+short: bit 5 - 7: run length (1 - 7), bit 0 - 4: color
+long: bit 5 - 7: 0, bit 0 - 4: color, then uint8_t run length - 8
+LZ packet (copy length octets from offset octets before):
+short: bit 0 - 5: length - 1 (1 - 63), then uint8_t offset - 1.
+every 4th short packet does not have offset octet, its offset - 1 is made of bit 6 - 7 of
+previous 3 short packets and itself (first one is highest 2 bits).
+long: bit 0 - 5: 0, bit 6 - 7: bit 8 - 9 of offset - 1, then uint8_t bit 0 - 7 of
+offset - 1, then uint8_t length - 3
+
+Run "python sffcodec.py" to run round trip checks with synthetic sprites.
+"""
+import re, random, time
+
+#every run of same octet
+CODEC_RUN_RX = re.compile(rb"([\x00-\xff])\1*")
+#repeating octet (2 or more)
+CODEC_REPEAT_RX = re.compile(rb"([\x00-\xff])\1+")
+
+#octet 0x40 - 0x7f and its next octet (RLE8 run)
+RLE8_RUN_RX = re.compile(rb"([\x40-\x7f][\x00-\xff])")
+#octet that can not be written without run
+RLE8_CTRL_RX = re.compile(rb"[\x40-\x7f]")
+RLE8_ESCAPE = {bytes((c, )): bytes((0x41, c)) for c in range(0x40, 0x80)}
+#expanded octets of every possible RLE8 run, built on first decode
+RLE8_RUNS = None
+
+#expanded octets of every RLE5 5 bit packet and LZ5 short RLE packet
+RLE5_PACKETS = [bytes((b & 0x1f, )) * ((b >> 5) + 1) for b in range(256)]
+LZ5_RUNS = [bytes((b & 0x1f, )) * (b >> 5) for b in range(256)]
+
+#decode RLE8 data into width x height pixels
+def rle8_decode(data, width, height):
+	global RLE8_RUNS
+	if RLE8_RUNS == None:
+		RLE8_RUNS = {bytes((0x40 | n, c)): bytes((c, )) * n for n in range(64) for c in range(256)}
+	#split into literal parts and runs (odd elements), then expand all runs by table lookup
+	t = RLE8_RUN_RX.split(bytes(data))
+	t[1::2] = map(RLE8_RUNS.__getitem__, t[1::2])
+	return b"".join(t)[:width * height]
+
+#encode width x height pixels into RLE8
+def rle8_encode(pixels, width, height):
+	pixels = bytes(pixels)
+	r = []
+	pos = 0
+	for m in CODEC_REPEAT_RX.finditer(pixels):
+		s = m.start()
+		#literal part, only 0x40 - 0x7f need to be written as 1 octet run
+		if s > pos:
+			r.append(RLE8_CTRL_RX.sub(lambda e: RLE8_ESCAPE[e[0]], pixels[pos:s]))
+		c = pixels[s]
+		n = m.end() - s
+		if n >= 63:
+			r.append(bytes((0x7f, c)) * (n // 63))
+			n %= 63
+		if n == 1 and not 0x40 <= c < 0x80:
+			r.append(bytes((c, )))
+		elif n != 0:
+			r.append(bytes((0x40 | n, c)))
+		pos = m.end()
+	if pos < len(pixels):
+		r.append(RLE8_CTRL_RX.sub(lambda e: RLE8_ESCAPE[e[0]], pixels[pos:]))
+	return b"".join(r)
+
+#decode RLE5 data into width x height pixels
+def rle5_decode(data, width, height):
+	data = bytes(data)
+	r = []
+	i = 0
+	end = len(data)
+	while i + 1 < end:
+		rl = data[i]
+		dl = data[i + 1]
+		i += 2
+		c = 0
+		if dl & 0x80:
+			c = data[i]
+			i += 1
+		dl &= 0x7f
+		r.append(bytes((c, )) * (rl + 1))
+		#expand all 5 bit packets at once
+		if dl != 0:
+			r.extend(map(RLE5_PACKETS.__getitem__, data[i:i + dl]))
+			i += dl
+	return b"".join(r)[:width * height]
+
+#encode width x height pixels into RLE5, returns None if pixels have color 32 or larger
+def rle5_encode(pixels, width, height):
+	pixels = bytes(pixels)
+	if len(pixels) != 0 and max(pixels) >= 32:
+		return None
+	runs = [(m[0][0], len(m[0])) for m in CODEC_RUN_RX.finditer(pixels)]
+	r = bytearray()
+	k = 0
+	while k < len(runs):
+		c, n = runs[k]
+		#first color of packet, run of it can be 256 long
+		if n > 256:
+			runs[k] = (c, n - 256)
+			n = 256
+		else:
+			k += 1
+		r.append(n - 1)
+		flag = len(r)
+		r.append(0)
+		if c != 0:
+			r.append(c)
+		#following short runs as 5 bit packets
+		dl = 0
+		while k < len(runs) and dl < 127 and runs[k][1] <= 8:
+			r.append(((runs[k][1] - 1) << 5) | runs[k][0])
+			dl += 1
+			k += 1
+		r[flag] = dl | (0x80 if c != 0 else 0)
+	return bytes(r)
+
+#decode LZ5 data into width x height pixels
+def lz5_decode(data, width, height):
+	data = bytes(data)
+	n = width * height
+	out = bytearray()
+	i = 0
+	end = len(data)
+	rb = 0 #recycled offset bits of short LZ packets
+	rbc = 0
+	while i < end and len(out) < n:
+		ct = data[i]
+		i += 1
+		for bit in range(8):
+			if i >= end:
+				break
+			d = data[i]
+			i += 1
+			if ct >> bit & 1 == 0:
+				#RLE packet
+				if d & 0xe0 == 0:
+					out += bytes((d, )) * (data[i] + 8)
+					i += 1
+				else:
+					out += LZ5_RUNS[d]
+				continue
+			#LZ packet
+			if d & 0x3f == 0:
+				off = ((d << 2) | data[i]) + 1
+				length = data[i + 1] + 3
+				i += 2
+			else:
+				rb |= (d & 0xc0) >> rbc
+				rbc += 2
+				length = (d & 0x3f) + 1
+				if rbc < 8:
+					off = data[i] + 1
+					i += 1
+				else:
+					off = rb + 1
+					rb = 0
+					rbc = 0
+			s = len(out) - off
+			if s < 0:
+				raise ValueError("LZ5 offset exceeds decoded data")
+			if off >= length:
+				out += out[s:s + length]
+			else:
+				#overlapping copy repeats last off octets
+				out += (out[s:] * (length // off + 1))[:length]
+	return bytes(out[:n])
+
+#returns length of same octets of p from a and b (a < b), up to limit
+def lz5_matchlen(p, a, b, limit):
+	k = 0
+	while k + 16 <= limit and p[a + k:a + k + 16] == p[b + k:b + k + 16]:
+		k += 16
+	while k < limit and p[a + k] == p[b + k]:
+		k += 1
+	return k
+
+#encode width x height pixels into LZ5, returns None if pixels have color 32 or larger
+def lz5_encode(pixels, width, height):
+	p = bytes(pixels)
+	n = len(p)
+	if n != 0 and max(p) >= 32:
+		return None
+	out = bytearray()
+	ctpos = 0
+	bit = 8
+	shorts = [] #positions of short LZ packets that wait for 4th one
+	chains = {} #3 octets -> positions that start with them (recent last)
+	j = 0
+	while j < n:
+		if bit == 8:
+			ctpos = len(out)
+			out.append(0)
+			bit = 0
+		c = p[j]
+		run = min(CODEC_RUN_RX.match(p, j).end() - j, 263)
+		#find longest match in last 1024 octets
+		m = 0
+		off = 0
+		cand = chains.get(p[j:j + 3])
+		if cand != None:
+			limit = min(n - j, 258)
+			for s in reversed(cand):
+				if j - s > 1024:
+					break
+				k = lz5_matchlen(p, s, j, limit)
+				if k > m:
+					m = k
+					off = j - s
+					if k == limit:
+						break
+		if m >= 3 and m > run:
+			out[ctpos] |= 1 << bit
+			if off <= 256 and m <= 64:
+				#short LZ packet
+				if len(shorts) < 3:
+					shorts.append(len(out))
+					out.append(m - 1)
+					out.append(off - 1)
+				else:
+					v = off - 1
+					out[shorts[0]] |= (v >> 6 & 3) << 6
+					out[shorts[1]] |= (v >> 4 & 3) << 6
+					out[shorts[2]] |= (v >> 2 & 3) << 6
+					out.append(((v & 3) << 6) | (m - 1))
+					shorts = []
+			else:
+				#long LZ packet
+				m = min(m, 258)
+				out.append(((off - 1) >> 8) << 6)
+				out.append((off - 1) & 0xff)
+				out.append(m - 3)
+			step = m
+		else:
+			#RLE packet
+			if run >= 8:
+				out.append(c)
+				out.append(run - 8)
+			else:
+				out.append((run << 5) | c)
+			step = run
+		bit += 1
+		#register positions for later matches
+		for t in range(j, min(j + step, n - 2)):
+			l = chains.setdefault(p[t:t + 3], [])
+			l.append(t)
+			if len(l) > 32:
+				del l[:16]
+		j += step
+	return bytes(out)
+
+#make width x height synthetic sprite pixels of colors < colors
+def codec_makepixels(rng, width, height, colors):
+	rows = []
+	for y in range(height):
+		row = bytearray(width)
+		x = rng.randrange(width)
+		while x < width:
+			n = rng.randint(1, 12)
+			row[x:x + n] = bytes((rng.randrange(colors), )) * min(n, width - x)
+			x += n + rng.choice((0, 0, 1, 3))
+		rows.append(bytes(row))
+	#repeat some rows like real sprites
+	for y in range(1, height):
+		if rng.random() < 0.3:
+			rows[y] = rows[y - 1]
+	return b"".join(rows)
+
+#round trip checks with synthetic sprites, returns count of failures
+def codec_selftest():
+	rng = random.Random(1)
+	codecs = (("RLE8", rle8_encode, rle8_decode), ("RLE5", rle5_encode, rle5_decode),
+		("LZ5", lz5_encode, lz5_decode))
+	cases = [(1, 1, b"\0"), (3, 1, b"\x40\x7f\x80"), (300, 1, b"\x05" * 300),
+		(16, 16, bytes(256)), (64, 64, bytes(rng.randrange(32) for i in range(4096)))]
+	for k in range(20):
+		w = rng.randint(1, 200)
+		h = rng.randint(1, 200)
+		cases.append((w, h, codec_makepixels(rng, w, h, 32 if k % 2 else 256)))
+	failed = 0
+	rle8_decode(b"", 0, 0) #build run table before measuring
+	for name, enc, dec in codecs:
+		size = 0
+		packed = 0
+		elapsed = 0
+		for w, h, pixels in cases:
+			data = enc(pixels, w, h)
+			if data == None:
+				if max(pixels) < 32:
+					print(f"{name}: {w}x{h}: Encode failed")
+					failed += 1
+				continue
+			t = time.perf_counter()
+			r = dec(data, w, h)
+			elapsed += time.perf_counter() - t
+			if r != pixels:
+				print(f"{name}: {w}x{h}: Round trip mismatch")
+				failed += 1
+			size += len(pixels)
+			packed += len(data)
+		print(f"{name}: {size} pixels -> {packed} octets, decode {size / elapsed / 1e6:.1f} MB/s")
+	return failed
+
+if __name__ == "__main__":
+	failed = codec_selftest()
+	print("All round trip checks passed." if failed == 0 else f"{failed} checks failed!")
+	raise SystemExit(1 if failed else 0)
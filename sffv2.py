@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""
+SFF v2 reader / writer for mugen toolchain
+(C) 2023 Kumohakase
+CC BY-SA 4.0 https://creativecommons.org/licenses/by-sa/4.0/
+Please consider supporting me through ko-fi.com
+https://ko-fi.com/kumohakase
+
+Used by sff.py (s mode) for sff v1 <-> v2 conversion.
+Sprite pixels are handled as bytes of width * height octets (row major, 1 octet per pixel),
+same as pcx.py. Palettes are handled as 768 octets of RGB.
+
+SFF v2 file structure:
+Header (Offset = 0, 512 octets)
++0x0, 12 octets, FileIdentifier ("ElecbyteSpr\0")
++0xc, 4 octets, Version (0, 1, 0, 2 = v2.01)
++0x18, 4 octets, Compatible version (0, 0, 0, 2)
++0x24, uint32_t, First sprite node offset
++0x28, uint32_t, Sprite count
++0x2c, uint32_t, First palette node offset
++0x30, uint32_t, Palette count
++0x34, uint32_t, ldata offset
++0x38, uint32_t, ldata length
++0x3c, uint32_t, tdata offset
++0x40, uint32_t, tdata length
+
+Sprite node (28 octets each, continuous)
++0x0, uint16_t, Group#
++0x2, uint16_t, Image#
++0x4, uint16_t, Width
++0x6, uint16_t, Height
++0x8, int16_t, Axis X
++0xa, int16_t, Axis Y
++0xc, uint16_t, Linked sprite index (if data length = 0)
++0xe, uint8_t, Format (0 = raw, 1 = linked, 2 = RLE8, 3 = RLE5, 4 = LZ5, 10-12 = PNG)
++0xf, uint8_t, Color depth (8)
++0x10, uint32_t, Data offset (in ldata or tdata)
++0x14, uint32_t, Data length (0 = linked)
++0x18, uint16_t, Palette index
++0x1a, uint16_t, Flags (bit 0: 0 = data is in ldata, 1 = data is in tdata)
+
+Palette node (16 octets each, continuous)
++0x0, uint16_t, Group#
++0x2, uint16_t, Item#
++0x4, uint16_t, Color count
++0x6, uint16_t, Linked palette index (if data length = 0)
++0x8, uint32_t, Data offset (in ldata)
++0xc, uint32_t, Data length (0 = linked)
+
+Palette data is color count * RGBA (A is unused, 0).
+Compressed sprite data (RLE8, RLE5, LZ5) starts with uint32_t uncompressed length.
+Files written by this module are laid out as
+header, sprite nodes, palette nodes, ldata (palettes), tdata (sprites).
+"""
+import os, struct, mmap
+from sffcodec import rle8_encode, rle8_decode, rle5_encode, rle5_decode, lz5_encode, lz5_decode
+
+SFFV2_SIGNATURE = b"ElecbyteSpr\0"
+SFFV2_VERSION = bytes((0, 1, 0, 2))
+SFFV2_COMPATVERSION = bytes((0, 0, 0, 2))
+#first sprite node offset, sprite count, first palette node offset, palette count,
+#ldata offset, ldata length, tdata offset, tdata length
+SFFV2_HEADER = "<LLLLLLLL"
+SFFV2_SPRITENODE = "<HHHHhhHBBLLHH"
+SFFV2_SPRITENODE_LEN = 28
+SFFV2_PALNODE = "<HHHHLL"
+SFFV2_PALNODE_LEN = 16
+
+#sprite data formats
+SFFV2_RAW = 0
+SFFV2_LINKED = 1
+SFFV2_RLE8 = 2
+SFFV2_RLE5 = 3
+SFFV2_LZ5 = 4
+SFFV2_FORMATNAMES = {0: "Raw", 1: "Linked", 2: "RLE8", 3: "RLE5", 4: "LZ5", 10: "PNG8",
+	11: "PNG24", 12: "PNG32"}
+
+#sprite data decoders, format -> function(data, width, height) that returns pixels
+#(data of compressed format is without uncompressed length)
+SFFV2_DECODERS = {SFFV2_RAW: lambda data, width, height: bytes(data), SFFV2_RLE8: rle8_decode,
+	SFFV2_RLE5: rle5_decode, SFFV2_LZ5: lz5_decode}
+
+#sprite data encoders, format -> function(pixels, width, height) that returns compressed data
+#(without uncompressed length) or None if pixels can not be stored in the format
+SFFV2_ENCODERS = {SFFV2_RLE8: rle8_encode, SFFV2_RLE5: rle5_encode, SFFV2_LZ5: lz5_encode}
+
+#encode pixels of width x height sprite in smallest format, returns (format, data)
+def sffv2_encode(pixels, width, height):
+	fmt = SFFV2_RAW
+	r = bytes(pixels)
+	for k, enc in SFFV2_ENCODERS.items():
+		d = enc(pixels, width, height)
+		if d == None:
+			continue
+		d = struct.pack("<L", len(pixels)) + d
+		if len(d) < len(r):
+			fmt = k
+			r = d
+	return (fmt, r)
+
+#returns True if buf (at least 16 octets of file head) is sff v2
+def sffv2_isv2(buf):
+	return bytes(buf[0:0xc]) == SFFV2_SIGNATURE and buf[0xf] == 2
+
+#Information of one sprite in sff v2
+#offset: absolute data offset in file, size: data length (0 if linked),
+#link: linked sprite index (None if not linked), palette: palette index
+class SpriteNode:
+	__slots__ = ("group", "image", "width", "height", "x", "y", "link", "fmt", "depth",
+		"offset", "size", "palette")
+
+	def __init__(self, group, image, width, height, x, y, link, fmt, depth, offset, size, palette):
+		self.group = group
+		self.image = image
+		self.width = width
+		self.height = height
+		self.x = x
+		self.y = y
+		self.link = link
+		self.fmt = fmt
+		self.depth = depth
+		self.offset = offset
+		self.size = size
+		self.palette = palette
+
+#Read only sff v2 file object backed by mmap, like SffArchive of sff.py
+#sprites: list of SpriteNode, palettes: list of 768 octets RGB (linked palettes are resolved)
+class SffV2Archive:
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, "rb")
+		if os.fstat(self.file.fileno()).st_size == 0:
+			self.map = None
+			self.view = memoryview(b"")
+		else:
+			self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+			self.view = memoryview(self.map)
+		self.sprites = None
+		self.palettes = None
+
+	#parse header and node tables (only once), returns False if fail
+	def parse(self):
+		if self.sprites != None:
+			return True
+		sff = self.view
+		if len(sff) < 0x44 or not sffv2_isv2(sff):
+			print("Fatal: Not a sff v2 file.")
+			return False
+		sprptr, sprcount, palptr, palcount, lofs, llen, tofs, tlen = struct.unpack_from(
+			SFFV2_HEADER, sff, 0x24)
+		if sprptr + sprcount * SFFV2_SPRITENODE_LEN > len(sff) or \
+			palptr + palcount * SFFV2_PALNODE_LEN > len(sff):
+			print("Fatal: Broken node table.")
+			return False
+		#palettes
+		nodes = list(struct.iter_unpack(SFFV2_PALNODE,
+			sff[palptr:palptr + palcount * SFFV2_PALNODE_LEN]))
+		self.palettes = []
+		for i in range(len(nodes)):
+			grp, item, cols, li, off, size = nodes[i]
+			if size == 0:
+				if li >= i:
+					print(f"Fatal: Palette {i}: link id is not previous palette.")
+					return False
+				self.palettes.append(self.palettes[li])
+				continue
+			if cols == 0 or lofs + off + size > len(sff):
+				print(f"Fatal: Palette {i}: Broken palette.")
+				return False
+			#v2.01 palette is RGBA, v2.00 palette may be RGB
+			stride = size // cols
+			d = bytes(sff[lofs + off:lofs + off + size])
+			pal = b"".join([d[k:k + 3] for k in range(0, cols * stride, stride)])
+			self.palettes.append(pal[:768].ljust(768, b"\0"))
+		#sprites
+		self.sprites = []
+		for e in struct.iter_unpack(SFFV2_SPRITENODE,
+			sff[sprptr:sprptr + sprcount * SFFV2_SPRITENODE_LEN]):
+			grp, img, w, h, x, y, li, fmt, depth, off, size, pal, flags = e
+			base = tofs if flags & 1 else lofs
+			link = None
+			if size == 0:
+				link = li
+			self.sprites.append(SpriteNode(grp, img, w, h, x, y, link, fmt, depth, base + off,
+				size, pal))
+		return True
+
+	#returns memoryview of length octets from off
+	def read(self, off, length):
+		return self.view[off:off + length]
+
+	#returns actual (not linked) sprite index of sprite i, None if link is broken
+	def resolve(self, i):
+		seen = set()
+		while self.sprites[i].link != None:
+			seen.add(i)
+			i = self.sprites[i].link
+			if i >= len(self.sprites) or i in seen:
+				return None
+		return i
+
+	#returns pixels of sprite i (linked sprite is resolved), None if sprite data is broken
+	#or format is not supported
+	def pixels(self, i):
+		i = self.resolve(i)
+		if i == None:
+			return None
+		e = self.sprites[i]
+		dec = SFFV2_DECODERS.get(e.fmt)
+		#5 bit sprites (RLE5, LZ5) are also indexes of 256 color palette
+		if dec == None or e.depth > 8:
+			return None
+		data = self.read(e.offset, e.size)
+		if e.fmt != SFFV2_RAW:
+			#skip uncompressed length
+			data = data[4:]
+		try:
+			r = dec(data, e.width, e.height)
+		except(IndexError, ValueError):
+			return None
+		if r == None or len(r) != e.width * e.height:
+			return None
+		return r
+
+	def close(self):
+		self.view.release()
+		if self.map != None:
+			try:
+				self.map.close()
+			except(BufferError):
+				pass
+		self.file.close()
+
+#write sff v2 file into binary file object f. palettes is list of 768 octets RGB, count is
+#sprite count and sprites is iterable of (SpriteNode, data) for each sprite in order, data is
+#encoded sprite data (with uncompressed length for compressed format, empty for linked
+#sprite). offset of SpriteNode is ignored. sprite data is streamed into f.
+def sffv2_write(f, palettes, count, sprites):
+	sprptr = 0x200
+	palptr = sprptr + count * SFFV2_SPRITENODE_LEN
+	lofs = palptr + len(palettes) * SFFV2_PALNODE_LEN
+	llen = len(palettes) * 1024
+	tofs = lofs + llen
+	#palette nodes and ldata
+	f.seek(palptr)
+	for i in range(len(palettes)):
+		f.write(struct.pack(SFFV2_PALNODE, 1, i + 1, 256, 0, i * 1024, 1024))
+	for pal in palettes:
+		f.write(b"".join([pal[k:k + 3] + b"\0" for k in range(0, 768, 3)]))
+	#tdata, sprite nodes are kept until all data are written
+	nodes = []
+	tlen = 0
+	for e, data in sprites:
+		fmt = e.fmt
+		li = 0
+		if e.link != None:
+			fmt = SFFV2_LINKED
+			li = e.link
+		nodes.append(struct.pack(SFFV2_SPRITENODE, e.group, e.image, e.width, e.height,
+			e.x, e.y, li, fmt, e.depth, tlen if len(data) != 0 else 0, len(data), e.palette,
+			1))
+		f.write(data)
+		tlen += len(data)
+	if len(nodes) != count:
+		raise ValueError(f"sprite count mismatch ({len(nodes)} != {count})")
+	f.seek(sprptr)
+	f.write(b"".join(nodes))
+	#header
+	f.seek(0)
+	f.write(SFFV2_SIGNATURE + SFFV2_VERSION + bytes(8) + SFFV2_COMPATVERSION + bytes(8))
+	f.write(struct.pack(SFFV2_HEADER, sprptr, count, palptr, len(palettes), lofs, llen,
+		tofs, tlen))
+	f.write(bytes(8))
+	f.write(b"Made by kumotech sff.py (C) 2023 kumohakase")
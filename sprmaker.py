@@ -15,6 +15,7 @@ and -p option might be buggy
 """
 
 import sys, os, struct
+from pcx import pcx_haspalette, pcx_tryremovepal
 
 #ask number, ask again if NaN passed or out of range of limmin-limmax
 def asknumber(askstr, limmin, limmax):
@@ -39,7 +40,8 @@ def main():
 	linkfiles = False
 	removepal = False
 	debug = False
-	global quiet = False
+	global quiet
+	quiet = False
 	for i in sys.argv:
 		#-c for autocrop mode, auto remove empty area of images
 		if i == "-c":
@@ -157,10 +159,10 @@ Choose(was {pal_mode}): """
 		if e[6] == 2:
 			pm = 1
 			#if shared palette mode and palette removal mode, remove palette from file
-			if removepal and data[1] == 5 and data[-769] == 12:
+			if removepal and data[1] == 5 and pcx_haspalette(data):
 				if debug:
 					print(f"{i}: Deleting palette info from data")
-				data = data[:-769]
+				data = pcx_tryremovepal(data)
 		#prepare header
 		hdr = struct.pack("<LLhhHHHB", nextptr, len(data), e[3], e[4], e[1], e[2], linkid, pm)
 		hdr += b"\0\0\0\0\0\0\0\0\0\0\0\0\0"